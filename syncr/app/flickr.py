@@ -1,15 +1,39 @@
 import calendar
 from datetime import datetime, timedelta
 import flickrapi
+import itertools
 import math
+import Queue
+import sys
+import threading
+import time
 from time import strptime
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import reset_queries, transaction
 from django.template import defaultfilters
 from django.utils.encoding import smart_str
 
+from syncr.app.flickrcache import CachedFlickrAPI
+from syncr.bulk import filter_in, insert_many, reconcile_m2m, update_many, \
+     update_tags_many
 from syncr.flickr.models import *
-from syncr.flickr.slug import get_unique_slug_for_photo
+from syncr.flickr.sampling import invalidate_random_photo_pool
+from syncr.flickr.slug import SlugAllocator
+
+# Listing extras carrying everything ``_getListingRecord`` needs
+FLICKR_EXTRAS = ','.join(('description', 'license', 'date_upload',
+    'date_taken', 'owner_name', 'original_format', 'last_update', 'geo',
+    'tags', 'media', 'count_comments', 'o_dims', 'url_t', 'url_s', 'url_m',
+    'url_l', 'url_o'))
+
+# Whether a changed photo refetches a group of fields. New photos always
+# fetch all of them; unchanged photos none.
+FLICKR_REFETCH = {'sizes': True, 'exif': True, 'geo': True}
+
+# Size labels of ``getPhotoSizes`` and their listing extras suffix
+FLICKR_EXTRAS_SIZES = (('Thumbnail', 't'), ('Small', 's'), ('Medium', 'm'),
+                       ('Large', 'l'), ('Original', 'o'))
 
 class FlickrSyncr:
     """
@@ -23,27 +47,95 @@ class FlickrSyncr:
     This app requires Beej's flickrapi library. Available at:
     http://flickrapi.sourceforge.net/
     """
-    def __init__(self, flickr_key, flickr_secret):
+    def __init__(self, flickr_key, flickr_secret, workers=1, use_extras=False,
+                 refetch=None, cache_dir=None):
         """
         Construct a new FlickrSyncr object.
 
         Required arguments
           flickr_key: a Flickr API key string
           flickr_secret: a Flickr secret key as a string
+        Optional arguments
+          workers: the maximum number of threads used for concurrent
+                   Flickr API calls, defaults to 1 (no threads). Database
+                   writes always happen on the calling thread.
+          use_extras: if true, photos are built from the listing calls
+                      with ``FLICKR_EXTRAS`` instead of being refetched
+                      one by one with photos_getInfo and photos_getSizes
+          refetch: a dictionary overriding ``FLICKR_REFETCH``, e.g.
+                   {'exif': False} to never refetch the exif data of a
+                   photo once it's stored
+          cache_dir: a directory to keep a ``CachedFlickrAPI`` response
+                     cache in; wrap ``self.flickr`` yourself to change
+                     its TTLs or size
         """
-        self.flickr = flickrapi.FlickrAPI(flickr_key, flickr_secret, format='xmlnode')
+        # ElementTree is much cheaper to build and search than XMLNode
+        self.flickr = flickrapi.FlickrAPI(flickr_key, flickr_secret, format='etree')
+        if cache_dir is not None:
+            self.flickr = CachedFlickrAPI(self.flickr, cache_dir)
+        self.workers = max(int(workers), 1)
+        self.use_extras = use_extras
+        self.refetch = dict(FLICKR_REFETCH)
+        self.refetch.update(refetch or {})
+        self.slugs = SlugAllocator()
+
+    def _getListingArgs(self):
+        """
+        Return the extra keyword arguments for flickr listing calls.
+
+        Without ``use_extras`` listings still carry the photos' last update
+        and media type, so unchanged photos and videos are skipped before
+        any per-photo call.
+        """
+        if self.use_extras:
+            return {'extras': FLICKR_EXTRAS}
+        return {'extras': 'last_update,media'}
+
+    def _map(self, func, items):
+        """
+        Apply ``func`` to every item and return the results in order.
+
+        With ``workers`` > 1 the calls are spread over a bounded pool of
+        threads. The first exception raised by a call is re-raised in
+        the calling thread once all threads have stopped.
+        """
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            return [func(item) for item in items]
+
+        results = [None] * len(items)
+        errors = []
+        queue = Queue.Queue()
+        for index, item in enumerate(items):
+            queue.put((index, item))
+
+        def worker():
+            while not errors:
+                try:
+                    index, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = func(item)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.workers, len(items)))]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
 
     def user2nsid(self, username):
         """
         Convert a flickr username to an NSID
         """
-        return self.flickr.people_findByUsername(username=username).user[0]['nsid']
-
-    def _getXMLNodeTag(self, node):
-        try:
-            return " ".join([x.text for x in node.photo[0].tags[0].tag])
-        except AttributeError:
-            return " "
+        return self.flickr.people_findByUsername(username=username).find('user').get('nsid')
 
     # Removed getPhotoSizeURLs() here
 
@@ -60,9 +152,9 @@ class FlickrSyncr:
         for label in ('Square','Thumbnail','Small','Medium','Large','Original'):
             sizes[label] = {'width': None, 'height': None}
         # Set values given by flickr
-        for el in result.sizes[0].size:
-            sizes[el['label']]['width'] = el['width']
-            sizes[el['label']]['height'] = el['height']
+        for el in result.find('sizes').findall('size'):
+            sizes[el.get('label')] = {'width': el.get('width'),
+                                      'height': el.get('height')}
         return sizes
 
     def getPhotoComments(self, photo_id):
@@ -85,20 +177,19 @@ class FlickrSyncr:
         """
         result = self.flickr.photos_comments_getList(photo_id=photo_id)
         # try if photo has comments
-        try:
-            raw_comments = result.comments[0].comment
-        except AttributeError:
+        raw_comments = result.find('comments').findall('comment')
+        if not raw_comments:
             return None
 
         comments = []
         for el in raw_comments:
                 comments.append(
                     {
-                        'flickr_id': el['id'],
-                        'author_nsid': el['author'],
-                        'author': el['authorname'],
-                        'pub_date': datetime.fromtimestamp(int(el['datecreate'])),
-                        'permanent_url': el['permalink'],
+                        'flickr_id': el.get('id'),
+                        'author_nsid': el.get('author'),
+                        'author': el.get('authorname'),
+                        'pub_date': datetime.fromtimestamp(int(el.get('datecreate'))),
+                        'permanent_url': el.get('permalink'),
                         'comment': smart_str(el.text)
                     }
                 )
@@ -111,21 +202,6 @@ class FlickrSyncr:
         Required arguments
           photo_id: a flickr photo id as a string
         """
-        def getRawOrClean(xmlnode):
-            try:
-                return xmlnode.clean[0].text
-            except AttributeError:
-                try:
-                    return xmlnode.raw[0].text
-                except AttributeError:
-                    return ''
-
-        def testResultKey(result_elem, label):
-            if result_elem['label'] == label:
-                return getRawOrClean(result_elem)
-            else:
-                return None
-
         exif_data = {'Make': '', 'Model': '', 'Orientation': '',
                      'Exposure': '', 'Software': '', 'Aperture': '',
                      'ISO Speed': '', 'Metering Mode': '', 'Flash': '',
@@ -135,15 +211,13 @@ class FlickrSyncr:
         except flickrapi.FlickrError:
             return exif_data
 
-        try:
-            for exif_elem in result.photo[0].exif:
-                for label in exif_data.keys():
-                    data = testResultKey(exif_elem, label)
-                    if data and not exif_data[label]:
-                        exif_data[label] = data
-            return exif_data
-        except:
-            return exif_data
+        # One pass over the tags; the first non-empty value of a label wins
+        for exif_elem in result.find('photo').findall('exif'):
+            label = exif_elem.get('label')
+            if label in exif_data and not exif_data[label]:
+                exif_data[label] = exif_elem.findtext('clean') or \
+                                   exif_elem.findtext('raw') or ''
+        return exif_data
 
     def getGeoLocation(self, photo_id):
         """
@@ -159,13 +233,14 @@ class FlickrSyncr:
         except flickrapi.FlickrError:
             return geo_data
 
-        geo_data['latitude'] = float(result.photo[0].location[0]['latitude'])
-        geo_data['longitude'] = float(result.photo[0].location[0]['longitude'])
-        geo_data['accuracy'] = result.photo[0].location[0]['accuracy']
+        location = result.find('photo').find('location')
+        geo_data['latitude'] = float(location.get('latitude'))
+        geo_data['longitude'] = float(location.get('longitude'))
+        geo_data['accuracy'] = location.get('accuracy')
 
         for bit in ('locality', 'county', 'region', 'country',):
-            if hasattr(result.photo[0].location[0], bit):
-                geo_data[bit] = getattr(result.photo[0].location[0], bit)[0].text
+            if location.find(bit) is not None:
+                geo_data[bit] = location.findtext(bit)
 
         return geo_data
 
@@ -175,68 +250,58 @@ class FlickrSyncr:
         except KeyError:
             return ''
 
-    def _syncPhoto(self, photo_xml, refresh=False):
+    def _getPhotoFetchers(self):
         """
-        Synchronize a flickr photo with the Django backend.
-
-        Required Arguments
-          photo_xml: A flickr photos in Flickrapi's REST XMLNode format
+        Return the independent per-photo lookups as (key, method) pairs.
         """
-        if photo_xml.photo[0]['media'] != 'photo': # Ignore media like videos
-            return None
-        photo_id = photo_xml.photo[0]['id']
+        return (('sizes', self.getPhotoSizes),
+                ('exif', self.getExifInfo),
+                ('geo', self.getGeoLocation),
+                ('comments', self.getPhotoComments))
 
-        # if we're refreshing this data, then delete the Photo first...
-        if refresh:
-            try:
-                p = Photo.objects.get(flickr_id = photo_id)
-                p.delete()
-            except ObjectDoesNotExist:
-                pass
+    def _fetchPhotoDetails(self, wanted):
+        """
+        Fetch per-photo details for several photos at once.
 
-        sizes = self.getPhotoSizes(photo_id)
-        # Removed urls = self.getPhotoSizeURLs(photo_id)
-        exif_data = self.getExifInfo(photo_id)
-        geo_data = self.getGeoLocation(photo_id)
+        The lookups of all photos are fanned out over the worker pool.
+        Returns a dictionary mapping each photo id to a dictionary of
+        results keyed by the names used in ``_getPhotoFetchers``.
 
-        taken_date = datetime(*strptime(photo_xml.photo[0].dates[0]['taken'], "%Y-%m-%d %H:%M:%S")[:7])
-        upload_date = datetime.fromtimestamp(int(photo_xml.photo[0].dates[0]['posted']))
-        update_date = datetime.fromtimestamp(int(photo_xml.photo[0].dates[0]['lastupdate']))
+        Required Arguments
+          wanted: A list of (photo_id, keys) pairs naming the lookups to
+                  run for each photo
+        """
+        fetchers = dict(self._getPhotoFetchers())
+        tasks = [(photo_id, key) for photo_id, keys in wanted for key in keys]
+        results = self._map(lambda task: fetchers[task[1]](task[0]), tasks)
+        details = dict([(photo_id, {}) for photo_id, keys in wanted])
+        for (photo_id, key), result in zip(tasks, results):
+            details[photo_id][key] = result
+        return details
 
-        proposed_slug = defaultfilters.slugify(photo_xml.photo[0].title[0].text.lower())
-        slug = get_unique_slug_for_photo(taken_date, proposed_slug)
+    def _cleanTags(self, tag_list):
+        """
+        Return a TagField string for a list of flickr tags.
 
+        Geo-tags are left out and tags are dropped once the string would
+        exceed 255 characters.
+        """
         # Ignore tags if there are more chars than 255
         tags, count = '', 0
-        for tag in [(t, len(t) + 1) for t in self._getXMLNodeTag(photo_xml).split()]:
+        for tag in [(t, len(t) + 1) for t in tag_list]:
             if 255 <= (count + tag[1] - 1):
                 tags = tags[:-1]
                 break
             if not tag[0].startswith('geo:'): # Exclude ugly geo-tags
                 tags += u'%s ' % tag[0]
                 count += tag[1]
+        return tags
 
-        try:
-            original_secret = photo_xml.photo[0]['originalsecret']
-        except KeyError:
-            original_secret = ''
-
-
-        default_dict = {
-            'flickr_id': photo_xml.photo[0]['id'],
-            'owner': photo_xml.photo[0].owner[0]['username'],
-            'owner_nsid': photo_xml.photo[0].owner[0]['nsid'],
-            'title': photo_xml.photo[0].title[0].text, # TODO: Typography
-            'slug': slug,
-            'description': photo_xml.photo[0].description[0].text,
-            'taken_date': taken_date,
-            'upload_date': upload_date,
-            'update_date': update_date,
-            'photopage_url': photo_xml.photo[0].urls[0].url[0].text,
-            'farm': photo_xml.photo[0]['farm'],
-            'server': photo_xml.photo[0]['server'],
-            'secret': photo_xml.photo[0]['secret'],
-            'original_secret': original_secret,
+    def _getSizesRecord(self, sizes):
+        """
+        Return the Photo size fields for a ``getPhotoSizes`` dictionary.
+        """
+        return {
             'thumbnail_width': sizes['Thumbnail']['width'],
             'thumbnail_height': sizes['Thumbnail']['height'],
             'small_width': sizes['Small']['width'],
@@ -251,8 +316,13 @@ class FlickrSyncr:
             # Removed 'small_url': urls['Small'],
             # Removed 'medium_url': urls['Medium'],
             # Removed 'thumbnail_url': urls['Thumbnail'],
-            'tags': tags,
-            'license': photo_xml.photo[0]['license'],
+        }
+
+    def _getGeoRecord(self, geo_data):
+        """
+        Return the Photo geo fields for a ``getGeoLocation`` dictionary.
+        """
+        return {
             'geo_latitude': geo_data['latitude'],
             'geo_longitude': geo_data['longitude'],
             'geo_accuracy': geo_data['accuracy'],
@@ -260,6 +330,13 @@ class FlickrSyncr:
             'geo_county': geo_data['county'],
             'geo_region': geo_data['region'],
             'geo_country': geo_data['country'],
+        }
+
+    def _getExifRecord(self, exif_data):
+        """
+        Return the Photo exif fields for a ``getExifInfo`` dictionary.
+        """
+        return {
             'exif_model': self.getExifKey(exif_data, 'Model'),
             'exif_make': self.getExifKey(exif_data, 'Make'),
             'exif_orientation': self.getExifKey(exif_data, 'Orientation'),
@@ -273,39 +350,464 @@ class FlickrSyncr:
             'exif_color_space': self.getExifKey(exif_data, 'Color Space'),
         }
 
-        obj, created = Photo.objects.get_or_create(
-            flickr_id = photo_xml.photo[0]['id'], defaults=default_dict)
+    def _getInfoRecord(self, photo_xml):
+        """
+        Return the Photo fields found in a photos_getInfo response.
+
+        Required Arguments
+          photo_xml: A photos_getInfo response in Flickrapi's etree format
+        """
+        photo = photo_xml.find('photo')
+        attrib = photo.attrib
+        owner = photo.find('owner').attrib
+        dates = photo.find('dates').attrib
+
+        return {
+            'flickr_id': attrib['id'],
+            'owner': owner['username'],
+            'owner_nsid': owner['nsid'],
+            'title': photo.findtext('title'), # TODO: Typography
+            'description': photo.findtext('description'),
+            'taken_date': datetime(*strptime(dates['taken'], "%Y-%m-%d %H:%M:%S")[:6]),
+            'upload_date': datetime.fromtimestamp(int(dates['posted'])),
+            'update_date': datetime.fromtimestamp(int(dates['lastupdate'])),
+            'photopage_url': photo.findtext('urls/url'),
+            'farm': attrib['farm'],
+            'server': attrib['server'],
+            'secret': attrib['secret'],
+            'original_secret': attrib.get('originalsecret', ''),
+            'tags': self._cleanTags([tag.text for tag in photo.findall('tags/tag')]),
+            'license': attrib['license'],
+            'comment_count': int(photo.findtext('comments')),
+        }
+
+    def _getListingRecord(self, photo, owner_nsid=None):
+        """
+        Return the Photo fields found in a listing entry. Fields whose
+        extras weren't requested are left out; with ``FLICKR_EXTRAS``
+        this covers everything but the exif data and the place names of
+        geotagged photos.
+
+        Required Arguments
+          photo: A photo element of a listing in Flickrapi's etree format
+        Optional Arguments
+          owner_nsid: The owner of the photo, for listings like photo sets
+                      which only name it once
+        """
+        attrib = photo.attrib
+        owner_nsid = attrib.get('owner', owner_nsid)
+
+        record = {
+            'flickr_id': attrib['id'],
+            'owner_nsid': owner_nsid,
+            'title': attrib['title'],
+            'photopage_url': u'http://www.flickr.com/photos/%s/%s/' % (owner_nsid, attrib['id']),
+            'farm': attrib['farm'],
+            'server': attrib['server'],
+            'secret': attrib['secret'],
+        }
+        if 'ownername' in attrib:
+            record['owner'] = attrib['ownername']
+        description = photo.find('description')
+        if description is not None:
+            record['description'] = description.text or ''
+        if 'datetaken' in attrib:
+            record['taken_date'] = datetime(*strptime(attrib['datetaken'], "%Y-%m-%d %H:%M:%S")[:6])
+        if 'dateupload' in attrib:
+            record['upload_date'] = datetime.fromtimestamp(int(attrib['dateupload']))
+        if 'lastupdate' in attrib:
+            record['update_date'] = datetime.fromtimestamp(int(attrib['lastupdate']))
+        if 'originalformat' in attrib:
+            record['original_secret'] = attrib.get('originalsecret', '')
+        if 'tags' in attrib:
+            record['tags'] = self._cleanTags(attrib['tags'].split())
+        if 'license' in attrib:
+            record['license'] = attrib['license']
+        if 'count_comments' in attrib:
+            record['comment_count'] = int(attrib['count_comments'])
+
+        if 'latitude' in attrib:
+            latitude = float(attrib['latitude']) or None
+            record['geo_latitude'] = latitude
+            record['geo_longitude'] = float(attrib.get('longitude', 0)) or None
+            record['geo_accuracy'] = latitude is not None and attrib.get('accuracy') or None
+
+        if 'width_t' in attrib:
+            sizes = dict()
+            for label, suffix in FLICKR_EXTRAS_SIZES:
+                sizes[label] = {'width': attrib.get('width_%s' % suffix),
+                                'height': attrib.get('height_%s' % suffix)}
+            if sizes['Original']['width'] is None:
+                sizes['Original'] = {'width': attrib.get('o_width'),
+                                     'height': attrib.get('o_height')}
+            record.update(self._getSizesRecord(sizes))
+        return record
+
+    def _savePhotos(self, records, comments=None):
+        """
+        Create or update a page of Photos and store their new comments.
+
+        The page is written in one transaction (see ``_writePhotos``).
+        Once it is committed, the slugs of the new photos' days are
+        checked against photos another sync process committed meanwhile,
+        and duplicates are renamed in a second, short transaction.
+
+        Required Arguments
+          records: A list of dictionaries of Photo fields; ``None``
+                   entries (e.g. videos) are passed through
+        Optional Arguments
+          comments: A dictionary mapping flickr ids to lists of comments
+                    as returned by ``getPhotoComments``
+
+        Returns the Photo objects in the order of ``records``.
+        """
+        photos, days = self._writePhotos(records, comments)
+        if days:
+            fix_duplicates = transaction.commit_on_success(
+                self.slugs.fix_duplicates)
+            slugs = fix_duplicates(days)
+            for photo in filter(None, photos):
+                if photo.pk in slugs:
+                    photo.slug = slugs[photo.pk]
+        return photos
+
+    def _writePhotos(self, records, comments=None):
+        """
+        Create or update a page of Photos and store their new comments.
+
+        The stored rows of the page are loaded with one query, then new
+        photos and comments are inserted and changed photos updated in
+        bulk, all in one transaction. Existing photos are only updated if
+        flickr reports a newer ``update_date``; fields missing from a
+        record keep their stored values, as do slug and taken date.
+
+        Takes the same arguments as ``_savePhotos``. Returns the Photo
+        objects in the order of ``records`` and the taken dates of the
+        new photos.
+        """
+        comments = comments or {}
+        existing = dict([(row[0], row[1:]) for row in filter_in(
+            Photo.objects.values_list('flickr_id', 'pk', 'update_date',
+                                      'slug', 'taken_date', 'comment_count'),
+            'flickr_id', [int(r['flickr_id']) for r in records if r])])
 
-        # update if something changed
-        if obj.update_date < update_date:
-            # Never overwrite URL-relevant attributes
-            default_dict['slug'] = obj.slug
-            default_dict['taken_date'] = obj.taken_date
+        new_photos, changed_photos = {}, {}
+        for record in filter(None, records):
+            flickr_id = int(record['flickr_id'])
+            if flickr_id in new_photos:
+                continue
+            if flickr_id not in existing:
+                photo = Photo(**record)
+                proposed_slug = defaultfilters.slugify(photo.title.lower())
+                photo.slug = self.slugs.allocate(photo.taken_date, proposed_slug)
+                new_photos[flickr_id] = photo
+                continue
+            pk, update_date, slug, taken_date, comment_count = existing[flickr_id]
+            # update if something changed
+            if update_date < record['update_date']:
+                # Never overwrite URL-relevant attributes
+                fields = [f for f in record
+                          if f not in ('flickr_id', 'slug', 'taken_date')]
+                if 'geo_latitude' in fields:
+                    fields.append('geohash')
+                fields.sort()
+                changed_photos.setdefault(tuple(fields), []).append(
+                    Photo(pk=pk, **record))
+            elif record.get('comment_count') not in (None, comment_count):
+                changed_photos.setdefault(('comment_count',), []).append(
+                    Photo(pk=pk, comment_count=record['comment_count']))
 
-            updated_obj = Photo(pk=obj.pk, **default_dict)
-            updated_obj.save()
+        insert_many(Photo, new_photos.values())
+        for fields, photos in changed_photos.items():
+            update_many(Photo, photos, fields)
+
+        pks = dict([(flickr_id, row[0]) for flickr_id, row in existing.items()])
+        pks.update(dict(filter_in(Photo.objects.values_list('flickr_id', 'pk'),
+                                  'flickr_id', new_photos.keys())))
+        for flickr_id, photo in new_photos.items():
+            photo.pk = pks[flickr_id]
+        # TagField updates tags on post_save, which bulk writes bypass
+        tag_names = dict([(photo.pk, photo.tags)
+                          for photo in new_photos.values()])
+        for fields, photos in changed_photos.items():
+            if 'tags' in fields:
+                tag_names.update([(photo.pk, photo.tags) for photo in photos])
+        update_tags_many(Photo, tag_names)
 
         # Comments
-        comments = self.getPhotoComments(obj.flickr_id)
-        if comments is not None:
-            for c in comments:
-                c['photo'] = obj
-                comment, created = PhotoComment.objects.get_or_create(
-                                        flickr_id=c['flickr_id'], defaults=c)
-        return obj
+        photo_comments = {}
+        for flickr_id, comment_list in comments.items():
+            for c in comment_list or ():
+                c['photo_id'] = pks[int(flickr_id)]
+                photo_comments[c['flickr_id']] = c
+        for comment_id in filter_in(
+                PhotoComment.objects.values_list('flickr_id', flat=True),
+                'flickr_id', photo_comments.keys()):
+            del photo_comments[comment_id]
+        insert_many(PhotoComment,
+                    [PhotoComment(**c) for c in photo_comments.values()])
+
+        if new_photos or changed_photos:
+            invalidate_random_photo_pool()
+
+        photos = Photo.objects.in_bulk(pks.values())
+        return ([record and photos[pks[int(record['flickr_id'])]]
+                 for record in records],
+                set([photo.taken_date.date() for photo in new_photos.values()]))
+    _writePhotos = transaction.commit_on_success(_writePhotos)
+
+    def _getStoredPhotos(self, flickr_ids):
+        """
+        Return a dictionary mapping the flickr ids of stored photos to
+        dictionaries of the fields which decide what needs to be fetched.
+
+        Required Arguments
+          flickr_ids: A list of flickr photo ids
+        """
+        fields = ('flickr_id', 'update_date', 'comment_count',
+                  'geo_latitude', 'geo_longitude')
+        return dict([(row['flickr_id'], row) for row in filter_in(
+            Photo.objects.values(*fields), 'flickr_id',
+            [int(flickr_id) for flickr_id in flickr_ids])])
+
+    def _getDetailKeys(self, record, stored):
+        """
+        Return the keys of the per-photo lookups needed to complete a
+        photo record.
 
-    def _syncPhotoXMLList(self, photos_xml):
+        Nothing but new comments is fetched for photos whose stored
+        ``update_date`` isn't older than the record's. Changed photos
+        refetch what ``self.refetch`` asks for, new photos everything.
+        Comments are only fetched if the comment count reported by flickr
+        differs from the one seen last time, or isn't known.
+
+        Required Arguments
+          record: A dictionary of Photo fields
+          stored: The photo's entry of ``_getStoredPhotos`` or ``None``
+        """
+        unchanged = stored is not None and \
+                    stored['update_date'] >= record['update_date']
+        count = record.get('comment_count')
+        if count is None:
+            want_comments = not unchanged
+        else:
+            want_comments = count > 0 and (stored is None or
+                                           stored['comment_count'] != count)
+        if unchanged:
+            return want_comments and ['comments'] or []
+
+        if stored is None:
+            refetch = dict.fromkeys(self.refetch, True)
+        else:
+            refetch = self.refetch
+        keys = []
+        if refetch['sizes'] and 'thumbnail_width' not in record:
+            keys.append('sizes')
+        if refetch['exif']:
+            keys.append('exif')
+        coordinates = (record.get('geo_latitude'), record.get('geo_longitude'))
+        if refetch['geo'] and ('geo_latitude' not in record or (
+                coordinates[0] is not None and (stored is None or
+                coordinates != (stored['geo_latitude'],
+                                stored['geo_longitude'])))):
+            keys.append('geo')
+        if want_comments:
+            keys.append('comments')
+        return keys
+
+    def _syncRecords(self, records, stored=None):
+        """
+        Fetch what's missing from a page of photo records and save them.
+
+        Required Arguments
+          records: A list of dictionaries of Photo fields; ``None``
+                   entries (e.g. videos) are passed through
+        Optional Arguments
+          stored: The result of ``_getStoredPhotos`` for the records, if
+                  already known
+        """
+        if stored is None:
+            stored = self._getStoredPhotos(
+                [r['flickr_id'] for r in records if r])
+        details = self._fetchPhotoDetails([(record['flickr_id'],
+            self._getDetailKeys(record, stored.get(int(record['flickr_id']))))
+            for record in records if record])
+
+        comments = {}
+        for record in filter(None, records):
+            detail = details[record['flickr_id']]
+            if 'sizes' in detail:
+                record.update(self._getSizesRecord(detail['sizes']))
+            if 'exif' in detail:
+                record.update(self._getExifRecord(detail['exif']))
+            if 'geo' in detail:
+                record.update(self._getGeoRecord(detail['geo']))
+            if 'comments' in detail:
+                comments[record['flickr_id']] = detail['comments']
+                if record.get('comment_count') is None:
+                    record['comment_count'] = len(detail['comments'] or ())
+
+        # Database writes stay on this thread
+        return self._savePhotos(records, comments)
+
+    def _syncPhoto(self, photo_xml, refresh=False):
+        """
+        Synchronize a flickr photo with the Django backend.
+
+        Required Arguments
+          photo_xml: A photos_getInfo response in Flickrapi's etree format
+        Optional Arguments
+          refresh: A boolean, if true the Photo will be re-sync'd with flickr
+        """
+        if photo_xml.find('photo').get('media') != 'photo': # Ignore media like videos
+            return None
+        photo_id = photo_xml.find('photo').get('id')
+
+        # if we're refreshing this data, then delete the Photo first...
+        if refresh:
+            try:
+                p = Photo.objects.get(flickr_id = photo_id)
+                p.delete()
+                invalidate_random_photo_pool()
+            except ObjectDoesNotExist:
+                pass
+
+        return self._syncRecords([self._getInfoRecord(photo_xml)])[0]
+
+    def _syncListingRecords(self, records):
+        """
+        Synchronize a page of listing records (see ``_getListingRecord``)
+        with Django ORM.
+
+        With ``use_extras`` the records are saved as they are, so they
+        must have been listed with ``FLICKR_EXTRAS``. Otherwise every
+        photo which changed since the last sync is fetched with
+        photos_getInfo.
+
+        Required Arguments
+          records: A list of listing records; ``None`` entries (e.g.
+                   videos) are passed through
+        """
+        stored = self._getStoredPhotos([r['flickr_id'] for r in records if r])
+
+        def getRecord(record):
+            if record is None or self.use_extras:
+                return record
+            if 'update_date' in record:
+                photo = stored.get(int(record['flickr_id']))
+                if photo is not None and \
+                   photo['update_date'] >= record['update_date']:
+                    # Unchanged since the last sync, skip photos_getInfo
+                    return {'flickr_id': record['flickr_id'],
+                            'update_date': record['update_date']}
+            info = self.flickr.photos_getInfo(photo_id = record['flickr_id'])
+            if info.find('photo').get('media') != 'photo': # Ignore media like videos
+                return None
+            return self._getInfoRecord(info)
+
+        return self._syncRecords(self._map(getRecord, records), stored)
+
+    def _syncRecordStream(self, records, page_size=500):
+        """
+        Synchronize an iterable of listing records, such as ``iterPhotos``
+        returns, ``page_size`` records at a time. Neither the records nor
+        the saved photos are kept, so memory use doesn't grow with the
+        number of photos.
+
+        Returns the number of records synchronized.
+        """
+        records = iter(records)
+        count = 0
+        while True:
+            page = list(itertools.islice(records, page_size))
+            if not page:
+                return count
+            self._syncListingRecords(page)
+            count += len(page)
+
+    def _syncPhotoXMLList(self, photos_xml, owner_nsid=None):
         """
         Synchronize a list of flickr photos with Django ORM.
 
         Required Arguments
-          photos_xml: A list of photos in Flickrapi's REST XMLNode format.
+          photos_xml: A list of photos in Flickrapi's etree format.
+        Optional Arguments
+          owner_nsid: The owner of the photos, if the listing doesn't name
+                      it for every photo
+
+        Returns the Photo objects in the order of ``photos_xml``, with
+        ``None`` for videos.
         """
-        photo_list = []
-        for photo in photos_xml:
-            photo_result = self.flickr.photos_getInfo(photo_id = photo['id'])
-            photo_list.append(self._syncPhoto(photo_result))
-        return photo_list
+        return self._syncListingRecords([self._isPhoto(photo) and
+            self._getListingRecord(photo, owner_nsid) or None
+            for photo in photos_xml])
+
+    def _isPhoto(self, photo):
+        """
+        Tell whether a listing entry is a photo, rather than a video.
+        Listings without the ``media`` extra are assumed to be photos.
+        """
+        return photo.get('media', 'photo') == 'photo'
+
+    def _iterListing(self, method, node='photos', page=1, per_page=500,
+                     **kwargs):
+        """
+        Yield the photo elements of a paged flickr listing one page at a
+        time. The next page is only requested once the previous one has
+        been consumed.
+
+        Required Arguments
+          method: the flickrapi method returning the listing
+        Optional Arguments
+          node: the name of the element holding the photos
+          page: the first page to fetch
+          per_page: the number of photos per page, at most 500
+          kwargs: the arguments of ``method``
+        """
+        page_count = page
+        while page <= page_count:
+            result = method(per_page=per_page, page=page, **kwargs).find(node)
+            page_count = int(result.get('pages'))
+            yield result.findall('photo')
+            page += 1
+
+    def _iterListingRecords(self, pages, owner_nsid=None):
+        """
+        Yield the listing records of the photos in ``pages``, as
+        returned by ``_iterListing``, skipping videos.
+        """
+        for photos_xml in pages:
+            for photo in photos_xml:
+                if self._isPhoto(photo):
+                    yield self._getListingRecord(photo, owner_nsid)
+
+    def iterPhotos(self, username, since=None, extras=FLICKR_EXTRAS):
+        """
+        Yield the public photos of a flickr user as dictionaries of Photo
+        fields, without touching the database.
+
+        Pages of 500 photos are fetched as the records are consumed, so
+        the photos can be streamed into an export, an indexer or a
+        custom writer with constant memory use. Records only hold the
+        fields covered by ``extras`` (see ``_getListingRecord``); videos
+        are skipped.
+
+        Required arguments
+          username: a flickr username as a string
+        Optional arguments
+          since: a datetime; only photos uploaded after it are listed
+          extras: the listing extras to request, defaults to
+                  ``FLICKR_EXTRAS``
+        """
+        nsid = self.user2nsid(username)
+        if since is None:
+            pages = self._iterListing(self.flickr.people_getPublicPhotos,
+                                      user_id=nsid, extras=extras)
+        else:
+            pages = self._iterListing(self.flickr.photos_search,
+                user_id=nsid, extras=extras,
+                min_upload_date=calendar.timegm(since.timetuple()))
+        return self._iterListingRecords(pages, nsid)
 
     def syncPhoto(self, photo_id, refresh=False):
         """
@@ -320,25 +822,45 @@ class FlickrSyncr:
         photo = self._syncPhoto(photo_result, refresh=refresh)
         return photo
 
-    def syncAllPublic(self, username):
+    def syncAllPublic(self, username, chunk_size=500):
         """
         Synchronize all of a flickr user's photos with Django.
         WARNING: This could take a while!
 
+        The photos are synced one listing page of ``chunk_size`` photos
+        at a time. Every chunk is committed on its own and nothing of it
+        is kept afterwards, so memory use stays flat however many photos
+        there are. The number of photos done is stored as the account's
+        ``SyncState.public_offset`` after each chunk, and an interrupted
+        run continues from there the next time.
+
         Required arguments
           username: a flickr username as a string
+        Optional arguments
+          chunk_size: the number of photos per chunk, at most 500 (the
+                      largest page flickr returns), defaults to 500
         """
         nsid = self.user2nsid(username)
-        count = per_page = int(self.flickr.people_getInfo(
-		user_id=nsid).person[0].photos[0].count[0].text)
-        if count >= 500:
-            per_page = 500
-        pages = count // per_page
-        
-        for page in range(0, pages):
-            result = self.flickr.people_getPublicPhotos(
-		user_id=nsid, per_page=per_page, page=page)
-            self._syncPhotoXMLList(result.photos[0].photo)
+        state, created = SyncState.objects.get_or_create(owner_nsid=nsid,
+            defaults={'owner': username, 'sync_date': datetime.now()})
+        per_page = max(1, min(int(chunk_size), 500))
+        page = state.public_offset // per_page + 1
+
+        for photos_xml in self._iterListing(self.flickr.people_getPublicPhotos,
+                page=page, per_page=per_page, user_id=nsid,
+                **self._getListingArgs()):
+            self._syncPhotoXMLList(photos_xml, nsid)
+            # Forget what this chunk left behind before the next one
+            self.slugs.clear()
+            reset_queries()
+            state.public_offset = page * per_page
+            state.save()
+            page += 1
+
+        state.owner = username
+        state.public_offset = 0
+        state.sync_date = datetime.now()
+        state.save()
 
     def syncRecentPhotos(self, username, days=1):
         """
@@ -351,17 +873,54 @@ class FlickrSyncr:
                 to 1 (yesterday)
         """
         syncSince = datetime.now() - timedelta(days=days)
-        timestamp = calendar.timegm(syncSince.timetuple())
+        self._syncRecordStream(self.iterPhotos(username, since=syncSince,
+            **self._getListingArgs()))
+
+    def syncChangedSince(self, username, since=None, recently_updated=False):
+        """
+        Synchronize the photos of a flickr user which changed since the
+        last run of this method.
+
+        The highest ``lastupdate`` seen is stored as the account's
+        ``SyncState.last_update`` once every page is processed, so a
+        failed run is simply repeated. The first run syncs everything.
+
+        Required arguments
+          username: a flickr username as a string
+        Optional arguments
+          since: a datetime to use instead of the stored watermark
+          recently_updated: if true, use flickr.photos.recentlyUpdated,
+                            which only lists changed photos but requires
+                            the API to be authenticated as ``username``.
+                            Otherwise the public photos are listed and
+                            filtered on their ``last_update`` extra.
+        """
         nsid = self.user2nsid(username)
+        state, created = SyncState.objects.get_or_create(owner_nsid=nsid,
+            defaults={'owner': username, 'sync_date': datetime.now()})
+        if since is None:
+            since = state.last_update or datetime.fromtimestamp(0)
 
-        result = self.flickr.photos_search(user_id=nsid, per_page=500,
-                                           min_upload_date=timestamp)
-        page_count = result.photos[0]['pages']
+        if recently_updated:
+            pages = self._iterListing(self.flickr.photos_recentlyUpdated,
+                min_date=int(time.mktime(since.timetuple())),
+                **self._getListingArgs())
+        else:
+            pages = self._iterListing(self.flickr.people_getPublicPhotos,
+                user_id=nsid, **self._getListingArgs())
 
-        for page in range(1, int(page_count)+1):
-            photo_list = self._syncPhotoXMLList(result.photos[0].photo)
-            result = self.flickr.photos_search(user_id=nsid, page=page+1,
-                        per_page=500, min_upload_date=timestamp)
+        watermark = [since]
+        def changed(records):
+            for record in records:
+                if record['update_date'] > since:
+                    watermark[0] = max(watermark[0], record['update_date'])
+                    yield record
+        self._syncRecordStream(changed(self._iterListingRecords(pages, nsid)))
+
+        state.owner = username
+        state.last_update = watermark[0]
+        state.sync_date = datetime.now()
+        state.save()
 
     def syncPublicFavorites(self, username):
         """Synchronize a flickr user's public favorites.
@@ -373,75 +932,143 @@ class FlickrSyncr:
         favList, created = FavoriteList.objects.get_or_create( \
 	    owner = username, defaults = {'sync_date': datetime.now()})
 
-        result = self.flickr.favorites_getPublicList(user_id=nsid, per_page=500)
-        page_count = int(result.photos[0]['pages'])
-        for page in range(1, page_count+1):
-            photo_list = self._syncPhotoXMLList(result.photos[0].photo)
-            for photo in photo_list:
-                favList.photos.add(photo)
-		if page == 1:
-		    favList.primary = photo
-		    favList.save()
-            result = self.flickr.favorites_getPublicList(user_id=nsid,
-                        per_page=500, page=page+1)
+        photo_list = []
+        for photos_xml in self._iterListing(self.flickr.favorites_getPublicList,
+                user_id=nsid, **self._getListingArgs()):
+            photo_list.extend(filter(None, self._syncPhotoXMLList(photos_xml)))
 
-    def syncPhotoSet(self, photoset_id, order=None):
+        # Faves which were removed on flickr are dropped from the list
+        reconcile_m2m(FavoriteList, 'photos',
+                      {favList.pk: [photo.pk for photo in photo_list]})
+        favList.primary = photo_list and photo_list[0] or None
+        favList.sync_date = datetime.now()
+        favList.save()
+
+    def _getPhotoSetPhotos(self, photoset_id):
         """
-        Synchronize a single flickr photo set based on the set id.
+        Return the photos of a flickr photo set, as a list of photo
+        elements of all pages of photosets_getPhotos.
 
         Required arguments
           photoset_id: a flickr photoset id number as a string
         """
-        photoset_xml = self.flickr.photosets_getInfo(photoset_id = photoset_id)
-        nsid = photoset_xml.photoset[0]['owner']
-        username = self.flickr.people_getInfo(user_id = nsid).person[0].username[0].text
-        result = self.flickr.photosets_getPhotos(photoset_id = photoset_id)
-        page_count = int(result.photoset[0]['pages'])
-	primary = self.syncPhoto(photoset_xml.photoset[0]['primary'])
+        photos_xml = []
+        for page in self._iterListing(self.flickr.photosets_getPhotos,
+                'photoset', photoset_id = photoset_id,
+                **self._getListingArgs()):
+            photos_xml.extend(page)
+        return photos_xml
+
+    def _savePhotoSet(self, photoset_xml, username, order, photos):
+        """
+        Create or update a PhotoSet, without its photos.
+
+        Required arguments
+          photoset_xml: a photoset element of photosets_getInfo or
+                        photosets_getList in Flickrapi's etree format
+          username: the flickr username of the set's owner
+          order: the position of the set among the owner's sets, or
+                 ``None`` to keep the stored one
+          photos: a dictionary mapping flickr ids to the synced Photos of
+                  the set, used to look up the primary photo
+        """
+        primary = photos.get(int(photoset_xml.get('primary')))
+        if primary is None:
+            primary = self.syncPhoto(photoset_xml.get('primary'))
 
         d_photoset, created = PhotoSet.objects.get_or_create(
-                flickr_id = photoset_id,
+                flickr_id = photoset_xml.get('id'),
                 defaults = {
-			'owner': username,
-			'flickr_id': result.photoset[0]['id'],
-			'title': photoset_xml.photoset[0].title[0].text,
-			'description': photoset_xml.photoset[0].description[0].text,
-			'primary': primary,
-			'order': order
-			}
-		)
-	if not created: # update it
-	    d_photoset.owner  = username
-	    d_photoset.title  = photoset_xml.photoset[0].title[0].text
-	    d_photoset.description=photoset_xml.photoset[0].description[0].text
-	    d_photoset.primary = primary
-	    d_photoset.save()
-
-	page_count = int(result.photoset[0]['pages'])
-	
-        for page in range(1, page_count+1):
-            if page > 1:
-                result = self.flickr.photosets_getPhotos(
-                    photoset_id = photoset_id, page = page+1)
-            photo_list = self._syncPhotoXMLList(result.photoset[0].photo)
-            for photo in photo_list:
-                if photo is not None:
-                    d_photoset.photos.add(photo)
+                    'owner': username,
+                    'flickr_id': photoset_xml.get('id'),
+                    'title': photoset_xml.findtext('title'),
+                    'description': photoset_xml.findtext('description'),
+                    'primary': primary,
+                    'order': order or 0
+                    }
+                )
+        if not created: # update it
+            d_photoset.owner  = username
+            d_photoset.title  = photoset_xml.findtext('title')
+            d_photoset.description = photoset_xml.findtext('description')
+            d_photoset.primary = primary
+            if order is not None:
+                d_photoset.order = order
+            d_photoset.save()
+        return d_photoset
+
+    def _setPhotoSetMembers(self, members):
+        """
+        Make photo sets hold exactly the given photos: memberships which
+        are missing are added and those of photos which were removed from
+        a set on flickr are deleted, with one query for the stored
+        memberships and a few bulk statements.
 
-        # Set primary photo and order
-        d_photoset.primary = Photo.objects.get(flickr_id__exact=result.photoset[0]['primary']) # TODO: This query isn't in need, we have the ``flickr_id``...
-        d_photoset.order = order
-        d_photoset.save()
+        Required arguments
+          members: a dictionary mapping PhotoSet primary keys to lists of
+                   Photo primary keys
+        """
+        # PhotoSet.photos has an intermediary model, so there is no add()
+        reconcile_m2m(PhotoSet, 'photos', members)
+
+    def syncPhotoSet(self, photoset_id, order=None):
+        """
+        Synchronize a single flickr photo set based on the set id.
+
+        Required arguments
+          photoset_id: a flickr photoset id number as a string
+        """
+        photoset_xml = self.flickr.photosets_getInfo(photoset_id = photoset_id)
+        nsid = photoset_xml.find('photoset').get('owner')
+        username = self.flickr.people_getInfo(user_id = nsid).findtext('person/username')
+        photo_list = filter(None, self._syncPhotoXMLList(
+            self._getPhotoSetPhotos(photoset_id), nsid))
+
+        d_photoset = self._savePhotoSet(photoset_xml.find('photoset'), username,
+            order, dict([(photo.flickr_id, photo) for photo in photo_list]))
+        self._setPhotoSetMembers(
+            {d_photoset.pk: [photo.pk for photo in photo_list]})
+        d_photoset.update_positions()
+        d_photoset.update_aggregates()
 
     def syncAllPhotoSets(self, username):
         """
         Synchronize all photo sets for a flickr user.
 
+        The photo lists of the sets are fetched concurrently (see
+        ``workers``) and every photo is synced only once, however many
+        sets it is in.
+
         Required arguments
           username: a flickr username as a string
         """
         nsid = self.user2nsid(username)
         result = self.flickr.photosets_getList(user_id=nsid)
+        photosets_xml = result.find('photosets').findall('photoset')
+        set_photos = self._map(self._getPhotoSetPhotos,
+                               [photoset.get('id') for photoset in photosets_xml])
+
+        # Sync the union of all sets, one page at a time
+        unique_photos, seen = [], set()
+        for photos_xml in set_photos:
+            for photo in photos_xml:
+                if photo.get('id') not in seen:
+                    seen.add(photo.get('id'))
+                    unique_photos.append(photo)
+        photos = {}
+        for i in range(0, len(unique_photos), 500):
+            for photo in self._syncPhotoXMLList(unique_photos[i:i + 500], nsid):
+                if photo is not None:
+                    photos[photo.flickr_id] = photo
 
-        for i, photoset in enumerate(result.photosets[0].photoset):
-            self.syncPhotoSet(photoset['id'], i + 1)
+        photosets, members = [], {}
+        for i, photoset_xml in enumerate(photosets_xml):
+            d_photoset = self._savePhotoSet(photoset_xml, username, i + 1,
+                                            photos)
+            photosets.append(d_photoset)
+            members[d_photoset.pk] = [photos[int(photo.get('id'))].pk
+                for photo in set_photos[i] if int(photo.get('id')) in photos]
+        self._setPhotoSetMembers(members)
+        for d_photoset in photosets:
+            d_photoset.update_positions()
+            d_photoset.update_aggregates()
@@ -0,0 +1,168 @@
+import os
+import tempfile
+import threading
+import time
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import flickrapi
+from django.utils.encoding import smart_str
+
+# Seconds a response of a flickr API method stays valid. ``None`` keeps
+# it forever; methods which aren't listed (e.g. all listings) are never
+# cached.
+FLICKR_CACHE_TTL = {
+    'flickr.people.findByUsername': 7 * 24 * 60 * 60,
+    'flickr.people.getInfo': 24 * 60 * 60,
+    'flickr.photosets.getInfo': 24 * 60 * 60,
+    'flickr.photos.getSizes': 24 * 60 * 60,
+    'flickr.photos.getExif': None,
+}
+
+class CachedFlickrAPI(object):
+    """
+    CachedFlickrAPI objects wrap a flickrapi.FlickrAPI object and keep
+    its responses in a directory of files.
+
+    Responses are keyed by API method and parameters and stored as the
+    raw REST XML, so they are parsed into whatever format the caller
+    asks for. Only successful responses are cached. Once the files take
+    up more than ``max_size`` bytes, the least recently used ones are
+    removed. The ``hits`` and ``misses`` counters tell how well the
+    cache does.
+    """
+    def __init__(self, flickr, path, ttl=None, max_size=100 * 1024 * 1024):
+        """
+        Construct a new CachedFlickrAPI object.
+
+        Required arguments
+          flickr: the flickrapi.FlickrAPI object to wrap
+          path: the directory to keep the responses in
+        Optional arguments
+          ttl: a dictionary overriding ``FLICKR_CACHE_TTL``; a TTL of 0
+               disables caching for a method
+          max_size: the size of the cache in bytes, defaults to 100 MB
+        """
+        self.flickr = flickr
+        self.path = path
+        self.ttl = dict(FLICKR_CACHE_TTL)
+        self.ttl.update(ttl or {})
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum([size for mtime, size, filename in self._getFiles()])
+
+    def __getattr__(self, attrib):
+        method = 'flickr.' + attrib.replace('_', '.')
+        if self.ttl.get(method, 0) == 0:
+            return getattr(self.flickr, attrib)
+
+        def call(**kwargs):
+            return self._call(attrib, method, kwargs)
+        return call
+
+    def _getFiles(self):
+        """
+        Return (mtime, size, filename) tuples of all cached responses.
+        """
+        files = []
+        for filename in os.listdir(self.path):
+            if filename.startswith('.'): # Still being written
+                continue
+            filename = os.path.join(self.path, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError: # Removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        return files
+
+    def _getFilename(self, method, kwargs):
+        items = kwargs.items()
+        items.sort()
+        key = '%s?%s' % (method, '&'.join(['%s=%s' % item for item in items]))
+        return os.path.join(self.path, sha1(smart_str(key)).hexdigest())
+
+    def _read(self, filename, ttl):
+        """
+        Return the cached response in ``filename`` if it's still valid,
+        otherwise ``None``.
+        """
+        try:
+            f = open(filename, 'rb')
+            try:
+                stored, data = f.read().split('\n', 1)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if ttl is not None and float(stored) + ttl < time.time():
+            return None
+        try:
+            os.utime(filename, None) # Mark as recently used
+        except OSError:
+            pass
+        return data
+
+    def _write(self, filename, data):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        content = '%f\n%s' % (time.time(), data)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+        self.lock.acquire()
+        try:
+            self.size += len(content)
+            if self.size > self.max_size:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        """
+        Remove the least recently used responses until the cache is down
+        to 90% of its size.
+        """
+        files = self._getFiles()
+        files.sort()
+        self.size = sum([size for mtime, size, filename in files])
+        for mtime, size, filename in files:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self.size -= size
+
+    def _call(self, attrib, method, kwargs):
+        format = kwargs.pop('format', self.flickr.default_format)
+        filename = self._getFilename(method, kwargs)
+        data = self._read(filename, self.ttl[method])
+
+        self.lock.acquire()
+        try:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        finally:
+            self.lock.release()
+
+        parser = flickrapi.rest_parsers.get(format, lambda flickr, data: data)
+        if data is None:
+            data = getattr(self.flickr, attrib)(format='rest', **kwargs)
+            # Raises FlickrError for failed calls, which aren't cached
+            parsed = parser(self.flickr, data)
+            self._write(filename, data)
+            return parsed
+        return parser(self.flickr, data)
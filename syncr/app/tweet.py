@@ -1,8 +1,29 @@
 import time
 from datetime import datetime
 import twitter
+from django.db import transaction
+from django.db.models import Max, Min
 from django.utils.encoding import smart_unicode
-from syncr.twitter.models import TwitterUser, Tweet
+from syncr.app.twittercache import UserCache
+from syncr.bulk import filter_in, insert_many, reconcile_m2m, update_many
+from syncr.twitter.models import TwitterUser, Tweet, index_entities
+from syncr.twitter.text import render_html
+
+# The most statuses Twitter returns per user timeline request
+TWITTER_PAGE_SIZE = 200
+
+# The most statuses python-twitter asks for per friends timeline request
+TWITTER_FRIENDS_PAGE_SIZE = 100
+
+# The most profiles Twitter returns per users/lookup request
+TWITTER_LOOKUP_SIZE = 100
+
+# The packed Twitter id lists mirroring the friends and followers relations
+TWITTER_GRAPH_IDS = {'friends': 'friend_ids', 'followers': 'follower_ids'}
+
+# The TwitterUser fields kept up to date from twitter.User profiles
+TWITTER_USER_FIELDS = ('twitter_id', 'description', 'location', 'name',
+                       'thumbnail_url', 'url')
 
 class TwitterSyncr:
     """TwitterSyncr objects sync Twitter information to the Django
@@ -13,20 +34,36 @@ class TwitterSyncr:
     access to only the most recent data in the Twitter system. This
     is for performance reasons (per API docs).
 
-    This app depends on python-twitter:
+    This app depends on python-twitter 0.8 or later, which
+    authenticates with OAuth:
     http://code.google.com/p/python-twitter/
     """
-    def __init__(self, username, password):
+    def __init__(self, username, consumer_key, consumer_secret,
+                 access_token_key, access_token_secret, user_cache=None):
         """Construct a new TwitterSyncr object.
 
         Required arguments
-          username: the Twitter user to use for authentication
-          password: the Twitter user's password to use for auth
+          username: the screen name of the authenticated Twitter user
+          consumer_key: the OAuth consumer key of the application
+          consumer_secret: the OAuth consumer secret of the application
+          access_token_key: the user's OAuth access token key
+          access_token_secret: the user's OAuth access token secret
+        Optional arguments
+          user_cache: the cache of Twitter user profiles, defaults to an
+                      in-memory UserCache; pass one with a Django cache
+                      backend to share profiles between processes
         """
         self.username = username
-        self.api = twitter.Api(username=username, password=password)
+        self.api = twitter.Api(consumer_key=consumer_key,
+                               consumer_secret=consumer_secret,
+                               access_token_key=access_token_key,
+                               access_token_secret=access_token_secret)
 
-        self.user_cache = dict()
+        if user_cache is None:
+            user_cache = UserCache()
+        self.user_cache = user_cache
+        # Identity map of the TwitterUser objects seen during this run
+        self.users = dict()
 
     def _getUser(self, user):
         """Retrieve Twitter user information, caching for performance
@@ -35,12 +72,70 @@ class TwitterSyncr:
         Required arguments
           user: a Twitter username as a string.
         """
-        if self.user_cache.has_key(user):
-            return self.user_cache[user]
-        else:
+        tw_user = self.user_cache.get(user)
+        if tw_user is None:
             tw_user = self.api.GetUser(user)
-            self.user_cache[user] = tw_user
-            return self.user_cache[user]
+            self.user_cache.set(user, tw_user)
+        return tw_user
+
+    def _getUserFields(self, user):
+        """Return the TwitterUser fields of a twitter.User object.
+        """
+        return {'twitter_id': user.id,
+                'description': user.description,
+                'location': user.location,
+                'name': user.name,
+                'thumbnail_url': user.profile_image_url or '',
+                'url': user.url,
+                }
+
+    def _loadTwitterUsers(self, screen_names):
+        """Add the stored TwitterUsers of the given screen names which
+        aren't in the identity map yet to it, with one query.
+        """
+        missing = [name for name in set(screen_names)
+                   if name not in self.users]
+        for obj in filter_in(TwitterUser.objects.all(), 'screen_name',
+                             missing):
+            self.users.setdefault(obj.screen_name, obj)
+
+    def _syncTwitterUsers(self, users):
+        """Synchronize twitter.User objects with the Django backend.
+
+        Users are looked up in the identity map ``self.users`` first and
+        in the database with a single query otherwise. New users are
+        inserted in bulk; stored users are only updated if their
+        profile changed.
+
+        Required arguments
+          users: a list of twitter.User objects
+
+        Returns a dictionary mapping screen names to TwitterUser objects.
+        """
+        profiles = dict([(user.screen_name, user) for user in users])
+        self._loadTwitterUsers(profiles.keys())
+
+        new_users, changed_users = [], []
+        for screen_name, user in profiles.items():
+            fields = self._getUserFields(user)
+            obj = self.users.get(screen_name)
+            if obj is None:
+                new_users.append(TwitterUser(screen_name=screen_name,
+                                             **fields))
+                continue
+            changed = False
+            for name, value in fields.items():
+                if getattr(obj, name) != value:
+                    setattr(obj, name, value)
+                    changed = True
+            if changed:
+                changed_users.append(obj)
+
+        insert_many(TwitterUser, new_users)
+        update_many(TwitterUser, changed_users, TWITTER_USER_FIELDS)
+        self._loadTwitterUsers([obj.screen_name for obj in new_users])
+        return dict([(screen_name, self.users[screen_name])
+                     for screen_name in profiles])
 
     def _syncTwitterUser(self, user):
         """Synchronize a twitter.User object with the Django backend
@@ -48,16 +143,7 @@ class TwitterSyncr:
         Required arguments
           user: a twitter.User object.
         """
-        default_dict = {'screen_name': user.screen_name,
-                        'description': user.description,
-                        'location': user.location,
-                        'name': user.name,
-                        'thumbnail_url': user.profile_image_url,
-                        'url': user.url,
-                        }
-        obj, created = TwitterUser.objects.get_or_create(screen_name = user.screen_name,
-                                                  defaults = default_dict)
-        return obj
+        return self._syncTwitterUsers([user])[user.screen_name]
 
     def syncUser(self, user):
         """Synchronize a Twitter user with the Django backend
@@ -68,6 +154,53 @@ class TwitterSyncr:
         user_obj = self._syncTwitterUser(self._getUser(user))
         return user_obj
 
+    def _parseCreatedAt(self, created_at):
+        """Return the datetime of a twitter.Status created_at string.
+        """
+        pub_time = time.strptime(created_at, "%a %b %d %H:%M:%S +0000 %Y")
+        return datetime.fromtimestamp(time.mktime(pub_time))
+
+    def ingestStatuses(self, statuses):
+        """Store a batch of twitter.Status objects in one transaction.
+
+        All timestamps are parsed and all users resolved (see
+        _syncTwitterUsers) up front, the stored ids are loaded with one
+        IN query and the new statuses are inserted in bulk, along with
+        their mentions, hashtags and links (see index_entities).
+        Statuses which are already stored are left alone.
+
+        Required arguments
+          statuses: a list of twitter.Status objects, e.g. a timeline
+                    page or an archive
+
+        Returns the number of new tweets.
+        """
+        pub_times = [self._parseCreatedAt(status.created_at)
+                     for status in statuses]
+        users = self._syncTwitterUsers([status.user for status in statuses])
+        stored = set(filter_in(Tweet.objects.values_list('twitter_id',
+            flat=True), 'twitter_id', [status.id for status in statuses]))
+
+        tweets = []
+        for status, pub_time in zip(statuses, pub_times):
+            if status.id in stored:
+                continue
+            stored.add(status.id)
+            text = smart_unicode(status.text)
+            tweets.append(Tweet(pub_time=pub_time,
+                                twitter_id=status.id,
+                                text=text,
+                                html=render_html(text),
+                                user=users[status.user.screen_name]))
+        insert_many(Tweet, tweets)
+        if tweets:
+            pks = dict(filter_in(Tweet.objects.values_list('twitter_id', 'pk'),
+                'twitter_id', [tweet.twitter_id for tweet in tweets]))
+            index_entities([(pks[tweet.twitter_id], tweet.text)
+                            for tweet in tweets])
+        return len(tweets)
+    ingestStatuses = transaction.commit_on_success(ingestStatuses)
+
     def _syncTwitterStatus(self, status):
         """
         Take a twitter.Status object and synchronize it to Django.
@@ -79,15 +212,18 @@ class TwitterSyncr:
           A syncr.twitter.models.Tweet Django object.
         """
         user = self._syncTwitterUser(status.user)
-        pub_time = time.strptime(status.created_at, "%a %b %d %H:%M:%S +0000 %Y")
-        pub_time = datetime.fromtimestamp(time.mktime(pub_time))
+        pub_time = self._parseCreatedAt(status.created_at)
+        text = smart_unicode(status.text)
         default_dict = {'pub_time': pub_time,
                         'twitter_id': status.id,
-                        'text': smart_unicode(status.text),
+                        'text': text,
+                        'html': render_html(text),
                         'user': user,
                         }
         obj, created = Tweet.objects.get_or_create(twitter_id = status.id,
                                                    defaults = default_dict)
+        if created:
+            index_entities([(obj.pk, text)])
         return obj
 
     def syncTweet(self, status_id):
@@ -99,16 +235,94 @@ class TwitterSyncr:
         status_obj = self.api.GetStatus(status_id)
         return self._syncTwitterStatus(status_obj)
 
-    def syncTwitterUserTweets(self, user):
-        """Synchronize a Twitter user's tweets with Django (currently
+    def _iterTimeline(self, fetch, since_id=None, max_id=None,
+                      max_pages=None, paging='max_id',
+                      page_size=TWITTER_PAGE_SIZE):
+        """Yield the pages of a timeline, newest statuses first, until a
+        page comes back empty or ``max_pages`` pages were fetched.
+
+        Required arguments
+          fetch: a twitter.Api timeline method, with its user bound
+        Optional arguments
+          since_id: only fetch statuses newer than this id
+          max_id: only fetch statuses up to this id
+          max_pages: the most pages to fetch
+          paging: 'max_id' to move to the next page by passing the
+                  oldest id seen minus one, 'page' for timelines which
+                  only take a page number
+          page_size: the statuses requested per page, defaults to
+                     TWITTER_PAGE_SIZE
+        """
+        page = 0
+        while max_pages is None or page < max_pages:
+            kwargs = {'count': page_size}
+            if since_id is not None:
+                kwargs['since_id'] = since_id
+            if paging == 'page':
+                kwargs['page'] = page + 1
+            elif max_id is not None:
+                kwargs['max_id'] = max_id
+            statuses = fetch(**kwargs)
+            if not statuses:
+                return
+            yield statuses
+            page += 1
+            max_id = min([status.id for status in statuses]) - 1
+
+    def syncTwitterUserTweets(self, user, incremental=False):
+        """Synchronize a Twitter user's tweets with Django (by default
         only the last 20 updates)
 
+        In incremental mode only the statuses newer than the newest one
+        seen by the previous incremental run (or else the newest one
+        stored) are requested, a page at a time, and the newest id is
+        kept as ``TwitterUser.last_tweet_id``. Once nothing is new, a run
+        costs a single, empty API call. Use backfillTwitterUserTweets to
+        fetch older statuses.
+
+        Required arguments
+          user: the Twitter user as string
+        Optional arguments
+          incremental: a boolean, see above
+        """
+        if not incremental:
+            self.ingestStatuses(self.api.GetUserTimeline(user))
+            return
+
+        since_id = TwitterUser.objects.filter(screen_name=user).aggregate(
+            since_id=Max('last_tweet_id'))['since_id']
+        if since_id is None:
+            since_id = Tweet.objects.filter(user__screen_name=user).aggregate(
+                since_id=Max('twitter_id'))['since_id']
+        newest = since_id
+        for statuses in self._iterTimeline(
+                lambda **kwargs: self.api.GetUserTimeline(user, **kwargs),
+                since_id=since_id, max_pages=since_id is None and 1 or None):
+            self.ingestStatuses(statuses)
+            newest = max([newest] + [status.id for status in statuses])
+        if newest != since_id:
+            TwitterUser.objects.filter(screen_name=user).update(
+                last_tweet_id=newest)
+            if user in self.users:
+                self.users[user].last_tweet_id = newest
+
+    def backfillTwitterUserTweets(self, user, max_pages=None):
+        """Synchronize a Twitter user's older tweets, walking back from
+        the oldest one stored a page at a time, until Twitter returns no
+        more of them or ``max_pages`` pages were fetched.
+
         Required arguments
           user: the Twitter user as string
+        Optional arguments
+          max_pages: the most pages of statuses to fetch
         """
-        statuses = self.api.GetUserTimeline(user)
-        for status in statuses:
-            self._syncTwitterStatus(status)
+        oldest = Tweet.objects.filter(user__screen_name=user).aggregate(
+            oldest=Min('twitter_id'))['oldest']
+        for statuses in self._iterTimeline(
+                lambda **kwargs: self.api.GetUserTimeline(user, **kwargs),
+                max_id=oldest is not None and oldest - 1 or None,
+                max_pages=max_pages):
+            self.ingestStatuses(statuses)
 
     def syncFriends(self, user):
         """Synchronize a Twitter user's friends with Django.
@@ -120,9 +334,8 @@ class TwitterSyncr:
         friends = self.api.GetFriends(user)
 
         # sync our list of twitter.User objs as into ORM
-        for friend in friends:
-            obj = self._syncTwitterUser(friend)
-            user_obj.friends.add(obj)
+        self._addToGraph(user_obj, 'friends',
+                         self._syncTwitterUsers(friends).values())
 
     def syncFollowers(self):
         """Synchronize the Twitter user's followers with Django. This
@@ -133,24 +346,160 @@ class TwitterSyncr:
         followers = self.api.GetFollowers()
 
         # sync our list of twitter.User objs into ORM
-        for follower in followers:
-            obj = self._syncTwitterUser(follower)
-            user_obj.followers.add(obj)
+        self._addToGraph(user_obj, 'followers',
+                         self._syncTwitterUsers(followers).values())
+
+    def _addToGraph(self, user_obj, field_name, objs):
+        """Add TwitterUsers to a user's friends or followers, and their
+        Twitter ids to the packed ``friend_ids`` or ``follower_ids``.
+        If the packed list was never stored, it is rebuilt from all the
+        related TwitterUsers.
+
+        Required arguments
+          user_obj: a TwitterUser object
+          field_name: 'friends' or 'followers'
+          objs: a list of TwitterUser objects
+        """
+        relation = getattr(user_obj, field_name)
+        relation.add(*objs)
+        packed_name = TWITTER_GRAPH_IDS[field_name]
+        ids = getattr(user_obj, packed_name)
+        if ids is None:
+            ids = relation.values_list('twitter_id', flat=True)
+        else:
+            ids = list(ids) + [obj.twitter_id for obj in objs]
+        setattr(user_obj, packed_name,
+                [twitter_id for twitter_id in ids if twitter_id is not None])
+        update_many(TwitterUser, [user_obj], [packed_name])
+
+    def _iterIds(self, fetch):
+        """Yield the user ids of a cursored id list (friends/ids or
+        followers/ids), one page at a time.
+
+        Required arguments
+          fetch: a twitter.Api id list method, with its user bound
+        """
+        cursor = -1
+        while cursor:
+            data = fetch(cursor=cursor)
+            if not isinstance(data, dict): # Not cursored
+                yield data
+                return
+            yield data.get('ids', [])
+            cursor = data.get('next_cursor', 0)
+
+    def _syncGraph(self, user_obj, field_name, pages):
+        """Make a user's friends or followers exactly the given accounts.
+
+        The stored TwitterUsers of the ids are looked up in one query
+        per page, and profiles are only fetched (a hundred per call) for
+        ids which were never seen. The relation is then brought in line
+        with one query for the stored rows and bulk inserts and deletes,
+        and all ids are stored packed in ``friend_ids`` or
+        ``follower_ids``.
+
+        Required arguments
+          user_obj: a TwitterUser object
+          field_name: 'friends' or 'followers'
+          pages: an iterable of lists of Twitter user ids, see _iterIds
 
-    def syncFriendsTweets(self, user):
-        """Synchronize the tweets of a Twitter user's friends (currently
+        Returns the primary keys of the related TwitterUsers.
+        """
+        pks, ids = {}, []
+        for page in pages:
+            page = [long(twitter_id) for twitter_id in page]
+            ids.extend(page)
+            pks.update(dict(filter_in(TwitterUser.objects.values_list(
+                'twitter_id', 'pk'), 'twitter_id', page)))
+            unseen = [twitter_id for twitter_id in page
+                      if twitter_id not in pks]
+            for i in range(0, len(unseen), TWITTER_LOOKUP_SIZE):
+                users = self.api.UsersLookup(
+                    user_id=unseen[i:i + TWITTER_LOOKUP_SIZE])
+                for user in users:
+                    self.user_cache.set(user.screen_name, user)
+                objs = self._syncTwitterUsers(users)
+                for user in users:
+                    pks[long(user.id)] = objs[user.screen_name].pk
+
+        # Accounts which can't be looked up (e.g. suspended) are left out
+        related = []
+        for twitter_id in ids:
+            if twitter_id in pks:
+                related.append(pks.pop(twitter_id))
+        reconcile_m2m(TwitterUser, field_name, {user_obj.pk: related})
+        packed_name = TWITTER_GRAPH_IDS[field_name]
+        setattr(user_obj, packed_name, ids)
+        update_many(TwitterUser, [user_obj], [packed_name])
+        return related
+
+    def syncFriendsGraph(self, user):
+        """Synchronize the complete list of a Twitter user's friends
+        with Django, adding new friends and removing those who were
+        unfollowed. Unlike syncFriends this pages through all of them.
+        Needs python-twitter 0.8's cursored GetFriendIDs and UsersLookup.
+
+        Required arguments
+          user: the Twitter username as a string
+        """
+        user_obj = self._syncTwitterUser(self._getUser(user))
+        return self._syncGraph(user_obj, 'friends', self._iterIds(
+            lambda **kwargs: self.api.GetFriendIDs(user, **kwargs)))
+
+    def syncFollowersGraph(self, user=None):
+        """Synchronize the complete list of a Twitter user's followers
+        with Django, adding new followers and removing those who left.
+        Unlike syncFollowers this pages through all of them. Needs
+        python-twitter 0.8's cursored GetFollowerIDs and UsersLookup.
+
+        Optional arguments
+          user: the Twitter username as a string, defaults to the
+                authenticated user
+        """
+        tw_user = self._getUser(user or self.username)
+        user_obj = self._syncTwitterUser(tw_user)
+        return self._syncGraph(user_obj, 'followers', self._iterIds(
+            lambda **kwargs: self.api.GetFollowerIDs(tw_user.id, **kwargs)))
+
+    def syncFriendsTweets(self, user, incremental=False):
+        """Synchronize the tweets of a Twitter user's friends (by default
         only the last 20 updates). Also automatically add these users
         as friends in the Django database, if they aren't already.
 
+        In incremental mode only the statuses newer than the newest one
+        seen by the previous incremental run are requested, a page at a
+        time, and the newest id is kept as
+        ``TwitterUser.last_friends_tweet_id``.
+
         Required arguments
           user: the Twitter username whose friend's tweets will sync
+        Optional arguments
+          incremental: a boolean, see above
         """
-        friend_updates = self.api.GetFriendsTimeline(user)
-        user_obj = self._syncTwitterUser(self._getUser(user))
-        
-        # loop through twitter.Status objects and sync them
-        for update in friend_updates:
-            self._syncTwitterStatus(update)
-            friend = self._syncTwitterUser(update.user)
-            user_obj.friends.add(friend)
+        if not incremental:
+            pages = [self.api.GetFriendsTimeline(user)]
+            user_obj = self._syncTwitterUser(self._getUser(user))
+        else:
+            self._loadTwitterUsers([user])
+            user_obj = self.users.get(user)
+            if user_obj is None:
+                user_obj = self._syncTwitterUser(self._getUser(user))
+            since_id = user_obj.last_friends_tweet_id
+            # The friends timeline has no max_id, so it is paged by number
+            pages = self._iterTimeline(
+                lambda **kwargs: self.api.GetFriendsTimeline(user, **kwargs),
+                since_id=since_id, max_pages=since_id is None and 1 or None,
+                paging='page', page_size=TWITTER_FRIENDS_PAGE_SIZE)
+
+        newest = user_obj.last_friends_tweet_id
+        for friend_updates in pages:
+            self.ingestStatuses(friend_updates)
+            newest = max([newest] + [update.id for update in friend_updates])
+            # the users of the page are in the identity map by now
+            self._addToGraph(user_obj, 'friends', self._syncTwitterUsers(
+                [update.user for update in friend_updates]).values())
+        if incremental and newest != user_obj.last_friends_tweet_id:
+            TwitterUser.objects.filter(pk=user_obj.pk).update(
+                last_friends_tweet_id=newest)
+            user_obj.last_friends_tweet_id = newest
 
@@ -0,0 +1,108 @@
+import threading
+import time
+
+class UserCache(object):
+    """
+    UserCache objects keep twitter.User profiles fetched by a
+    TwitterSyncr, so the same people aren't looked up over and over.
+
+    Profiles are kept in memory for ``ttl`` seconds; once there are more
+    than ``max_size`` of them, the least recently used ones are dropped.
+    With a Django cache ``backend`` (e.g. ``django.core.cache.cache``)
+    misses are looked up there and new profiles stored there too, so
+    several processes share their lookups. The ``hits`` and ``misses``
+    counters tell how well the cache does.
+
+    Any object with the same ``get`` and ``set`` methods can be passed to
+    TwitterSyncr instead.
+    """
+    def __init__(self, max_size=1000, ttl=60 * 60, backend=None,
+                 key_prefix='syncr.twitter.user.'):
+        """
+        Construct a new UserCache object.
+
+        Optional arguments
+          max_size: the most profiles kept in memory, defaults to 1000
+          ttl: the seconds a profile stays valid, defaults to an hour
+          backend: a Django cache object shared between processes
+          key_prefix: the prefix of the keys in ``backend``
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Entries are [previous, next, key, value, expires] lists linked
+        # from least to most recently used
+        self.entries = {}
+        self.root = [None, None, None, None, None]
+        self.root[0] = self.root[1] = self.root
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _append(self, entry):
+        last = self.root[0]
+        entry[0], entry[1] = last, self.root
+        last[1] = self.root[0] = entry
+
+    def _getLocal(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[4] < time.time():
+            self._unlink(entry)
+            del self.entries[key]
+            return None
+        self._unlink(entry)
+        self._append(entry)
+        return entry[3]
+
+    def _setLocal(self, key, value):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+        entry = [None, None, key, value, time.time() + self.ttl]
+        self._append(entry)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            oldest = self.root[1]
+            self._unlink(oldest)
+            del self.entries[oldest[2]]
+
+    def get(self, screen_name):
+        """
+        Return the cached profile of a screen name, or ``None``.
+        """
+        self.lock.acquire()
+        try:
+            user = self._getLocal(screen_name)
+            if user is None and self.backend is not None:
+                user = self.backend.get(self.key_prefix + screen_name)
+                if user is not None:
+                    self._setLocal(screen_name, user)
+            if user is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return user
+        finally:
+            self.lock.release()
+
+    def set(self, screen_name, user):
+        """
+        Cache the twitter.User profile of a screen name.
+        """
+        self.lock.acquire()
+        try:
+            self._setLocal(screen_name, user)
+        finally:
+            self.lock.release()
+        if self.backend is not None:
+            self.backend.set(self.key_prefix + screen_name, user, self.ttl)
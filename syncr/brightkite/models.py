@@ -1,6 +1,8 @@
 from django.db import models
 from django.db.models import signals
 
+from syncr.geo import GeohashField
+
 
 class Checkin(models.Model):
     """
@@ -12,6 +14,7 @@ class Checkin(models.Model):
     tiny_avtar = models.URLField(verify_exists=True)
     latitude = models.FloatField()
     longitude = models.FloatField()
+    geohash = GeohashField('latitude', 'longitude')
     created_at = models.DateTimeField()
     checkin_id = models.CharField(max_length=50)
     
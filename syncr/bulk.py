@@ -0,0 +1,230 @@
+"""
+Bulk database writes for the syncr apps.
+
+The Django ORM saves one row per query. These helpers write a whole
+batch of rows with a few statements instead. Like ``QuerySet.update()``
+they bypass ``save()`` and model signals, so callers have to take care
+of anything hooked to those themselves (e.g. TagField updates, see
+``update_tags_many``).
+"""
+from django.conf import settings
+from django.db import connection, models, transaction
+
+# Keep the number of parameters per statement below SQLite's limit of 999
+MAX_PARAMS = 900
+
+def _supports_multi_row_insert():
+    if settings.DATABASE_ENGINE == 'oracle':
+        return False
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 7, 11)
+    return True
+
+# Oracle and SQLite before 3.7.11 have no multi-row VALUES lists; insert
+# one row per executemany parameter set there instead
+MULTI_ROW_INSERT = _supports_multi_row_insert()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _insert_rows(cursor, table, columns, rows):
+    """
+    Insert rows (lists of column values) into a table, with multi-row
+    INSERT statements where the database supports them.
+    """
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES %%s' % (
+        qn(table), ', '.join([qn(column) for column in columns]))
+    placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+    if not MULTI_ROW_INSERT:
+        cursor.executemany(sql % placeholders, rows)
+        return
+    for chunk in _chunks(rows, max(MAX_PARAMS // len(columns), 1)):
+        params = []
+        for row in chunk:
+            params.extend(row)
+        cursor.execute(sql % ', '.join([placeholders] * len(chunk)), params)
+
+def insert_many(model, objs):
+    """
+    Insert model instances using multi-row INSERT statements.
+
+    Auto-incremented primary keys are left unset on the instances; look
+    them up by a unique field afterwards if they are needed.
+
+    Required arguments
+      model: the model class of the instances
+      objs: a list of unsaved model instances
+    """
+    if not objs:
+        return
+    opts = model._meta
+    fields = [f for f in opts.local_fields
+              if not isinstance(f, models.AutoField)]
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True)) for f in fields]
+            for obj in objs]
+    _insert_rows(connection.cursor(), opts.db_table,
+                 [f.column for f in fields], rows)
+    transaction.commit_unless_managed()
+
+def update_many(model, objs, field_names):
+    """
+    Update the given fields of saved model instances with a single
+    ``executemany`` call.
+
+    Required arguments
+      model: the model class of the instances
+      objs: a list of model instances with a primary key
+      field_names: the names of the fields to write
+    """
+    if not objs or not field_names:
+        return
+    opts = model._meta
+    fields = [opts.get_field(name) for name in field_names]
+    qn = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (qn(opts.db_table),
+        ', '.join(['%s = %%s' % qn(f.column) for f in fields]),
+        qn(opts.pk.column))
+    rows = []
+    for obj in objs:
+        row = [f.get_db_prep_save(f.pre_save(obj, False)) for f in fields]
+        row.append(opts.pk.get_db_prep_save(obj.pk))
+        rows.append(row)
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+def filter_in(queryset, field_name, values):
+    """
+    Yield the results of ``queryset`` restricted to rows whose
+    ``field_name`` is in ``values``. Long lists of values are split over
+    several queries to stay below the database's parameter limit.
+
+    Required arguments
+      queryset: the QuerySet (or ValuesQuerySet) to filter
+      field_name: the name of the field to look up
+      values: a list of values
+    """
+    values = list(values)
+    for chunk in _chunks(values, MAX_PARAMS):
+        for result in queryset.filter(**{'%s__in' % field_name: chunk}):
+            yield result
+
+def reconcile_m2m(model, field_name, members):
+    """
+    Make a many-to-many relation hold exactly the given objects.
+
+    The stored rows of all owners are loaded with one query, then the
+    missing rows are added in bulk (see ``insert_many``) and the surplus rows
+    removed with one DELETE per owner. This also works for relations with
+    an intermediary model, as long as its other columns may be left to
+    their database defaults (e.g. are nullable).
+
+    Returns a tuple of the numbers of added and removed rows.
+
+    Required arguments
+      model: the model class with the ManyToManyField
+      field_name: the name of the ManyToManyField
+      members: a dictionary mapping primary keys of ``model`` to lists of
+               primary keys of the related objects
+    """
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    table = qn(field.m2m_db_table())
+    column = qn(field.m2m_column_name())
+    reverse = qn(field.m2m_reverse_name())
+    cursor = connection.cursor()
+
+    stored = dict([(pk, set()) for pk in members])
+    owners = members.keys()
+    for chunk in _chunks(owners, MAX_PARAMS):
+        cursor.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (
+            column, reverse, table, column, ', '.join(['%s'] * len(chunk))),
+            chunk)
+        for owner, related in cursor.fetchall():
+            stored[model._meta.pk.to_python(owner)].add(related)
+
+    additions, removals = [], 0
+    for owner, related_pks in members.items():
+        wanted = set(related_pks)
+        for related in related_pks:
+            if related not in stored[owner]:
+                stored[owner].add(related)
+                additions.append([owner, related])
+        surplus = list(stored[owner] - wanted)
+        for chunk in _chunks(surplus, MAX_PARAMS - 1):
+            cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+                table, column, reverse, ', '.join(['%s'] * len(chunk))),
+                [owner] + chunk)
+        removals += len(surplus)
+
+    if additions:
+        _insert_rows(cursor, field.m2m_db_table(), [field.m2m_column_name(),
+                     field.m2m_reverse_name()], additions)
+    transaction.commit_unless_managed()
+    return len(additions), removals
+
+def update_tags_many(model, tag_names):
+    """
+    Set the django-tagging tags of many saved objects, like
+    ``Tag.objects.update_tags`` does for one.
+
+    The tags and tagged items of all objects are loaded with a query or
+    two each, then missing tags and tagged items are inserted in bulk and
+    stale tagged items removed with one DELETE per chunk.
+
+    Required arguments
+      model: the model class of the objects
+      tag_names: a dictionary mapping primary keys of ``model`` to tag
+                 input strings, e.g. the values of a TagField
+    """
+    from django.contrib.contenttypes.models import ContentType
+    from tagging import settings as tagging_settings
+    from tagging.models import Tag, TaggedItem
+    from tagging.utils import parse_tag_input
+
+    if not tag_names:
+        return
+    wanted = {}
+    for pk, names in tag_names.items():
+        names = parse_tag_input(names)
+        if tagging_settings.FORCE_LOWERCASE_TAGS:
+            names = [name.lower() for name in names]
+        wanted[pk] = names
+
+    all_names = set()
+    for names in wanted.values():
+        all_names.update(names)
+    tags = dict(filter_in(Tag.objects.values_list('name', 'pk'), 'name',
+                          all_names))
+    missing = [name for name in all_names if name not in tags]
+    insert_many(Tag, [Tag(name=name) for name in missing])
+    tags.update(dict(filter_in(Tag.objects.values_list('name', 'pk'),
+                               'name', missing)))
+
+    ctype = ContentType.objects.get_for_model(model)
+    stored = {}
+    for item_pk, object_id, tag_pk in filter_in(
+            TaggedItem.objects.filter(content_type=ctype).values_list(
+            'pk', 'object_id', 'tag'), 'object_id', wanted.keys()):
+        stored.setdefault(object_id, {})[tag_pk] = item_pk
+
+    additions, stale = [], []
+    for pk, names in wanted.items():
+        current = stored.get(pk, {})
+        tag_pks = set([tags[name] for name in names])
+        additions.extend([TaggedItem(tag_id=tag_pk, content_type=ctype,
+                                     object_id=pk)
+                          for tag_pk in tag_pks if tag_pk not in current])
+        stale.extend([item_pk for tag_pk, item_pk in current.items()
+                      if tag_pk not in tag_pks])
+
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for chunk in _chunks(stale, MAX_PARAMS):
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(TaggedItem._meta.db_table), qn(TaggedItem._meta.pk.column),
+            ', '.join(['%s'] * len(chunk))), chunk)
+    insert_many(TaggedItem, additions)
+    transaction.commit_unless_managed()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from syncr.flickr.models import Photo, FavoriteList, PhotoSet, PhotoComment
+from syncr.flickr.models import Photo, FavoriteList, PhotoSet, PhotoComment, \
+    SyncState
 
 
 class PhotoAdmin(admin.ModelAdmin):
@@ -17,7 +18,8 @@ class FavoriteListAdmin(admin.ModelAdmin):
 
 
 class PhotoSetAdmin(admin.ModelAdmin):
-    list_display = ('get_primary_photo', 'title', 'flickr_id', 'owner')
+    list_display = ('get_primary_photo', 'title', 'flickr_id', 'owner',
+                    'photo_count')
     list_display_links = ('title',)
     list_select_related = True # ``get_primary_photo`` uses a ForeignKey
 
@@ -30,7 +32,13 @@ class PhotoCommentAdmin(admin.ModelAdmin):
     search_fields = ['comment', 'author', 'photo__title']
 
 
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = ('owner', 'owner_nsid', 'last_update', 'public_offset',
+                    'sync_date')
+
+
 admin.site.register(Photo, PhotoAdmin)
 admin.site.register(FavoriteList, FavoriteListAdmin)
 admin.site.register(PhotoSet, PhotoSetAdmin)
 admin.site.register(PhotoComment, PhotoCommentAdmin)
+admin.site.register(SyncState, SyncStateAdmin)
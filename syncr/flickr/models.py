@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import connection, models
 from django.utils.html import strip_tags
 from django.utils.text import truncate_words
 from django.utils.translation import ugettext_lazy as _
@@ -6,6 +6,8 @@ from django.conf import settings
 
 from tagging.fields import TagField
 
+from syncr.geo import GeohashField
+
 FLICKR_LICENSES = (
     ('0', 'All Rights Reserved'),
     ('1', 'Attribution-NonCommercial-ShareAlike License'),
@@ -39,7 +41,7 @@ class Photo(models.Model):
     slug = models.SlugField(unique_for_date='taken_date',
                             help_text='Automatically built from the title.')
     description = models.TextField(blank=True)
-    taken_date = models.DateTimeField()
+    taken_date = models.DateTimeField(db_index=True)
     upload_date = models.DateTimeField() # New
     update_date = models.DateTimeField() # New (very)
     photopage_url = models.URLField()
@@ -63,6 +65,7 @@ class Photo(models.Model):
     original_height = models.PositiveSmallIntegerField() # New
     tags = TagField(blank=True)
     enable_comments = models.BooleanField(default=True)
+    comment_count = models.PositiveIntegerField(null=True, editable=False)
     license = models.CharField(max_length=50, choices=FLICKR_LICENSES)
     geo_latitude = models.FloatField(null=True)
     geo_longitude = models.FloatField(null=True)
@@ -71,6 +74,7 @@ class Photo(models.Model):
     geo_county = models.CharField(max_length=200, blank=True) # New
     geo_region = models.CharField(max_length=200, blank=True) # New
     geo_country = models.CharField(max_length=200, blank=True) # New
+    geohash = GeohashField('geo_latitude', 'geo_longitude')
     exif_make  = models.CharField(max_length=50, blank=True)
     exif_model = models.CharField(max_length=50, blank=True)
     exif_orientation = models.CharField(max_length=50, blank=True)
@@ -151,12 +155,46 @@ class Photo(models.Model):
         order = direction == 'next' and 'taken_date' or '-taken_date'
         filter = direction == 'next' and 'gt' or 'lt'
         try:
-            return self.photoset_set.get(pk=photoset.pk).photos.filter(
+            return photoset.photos.filter(
                 **{'taken_date__%s' % filter: self.taken_date}
                 ).order_by(order)[0]
         except IndexError:
             return None
 
+    def get_neighbors_in_set(self, photoset):
+        """
+        Returns a tuple of the previous and the next photo in ``photoset``
+        by ``taken_date``, either of which may be ``None``.
+
+        Both are found with one query on the positions stored by
+        ``PhotoSet.update_positions``. Sets synced before positions were
+        stored fall back to ``taken_date`` lookups.
+
+        """
+        qn = connection.ops.quote_name
+        position = '(SELECT %s FROM %s WHERE %s = %%s AND %s = %%s)' % (
+            qn('position'), qn(PhotoSetMembership._meta.db_table),
+            qn('photoset_id'), qn('photo_id'))
+        members = PhotoSetMembership.objects.select_related('photo').filter(
+            photoset=photoset).exclude(photo=self).extra(
+            select={'own_position': position},
+            select_params=(photoset.pk, self.pk),
+            where=['%s BETWEEN %s - 1 AND %s + 1' % (
+                qn('position'), position, position)],
+            params=(photoset.pk, self.pk, photoset.pk, self.pk))
+        previous = next = None
+        for member in members:
+            if member.position < member.own_position:
+                previous = member.photo
+            else:
+                next = member.photo
+        if previous is None and next is None and \
+           not PhotoSetMembership.objects.filter(photoset=photoset,
+                photo=self, position__isnull=False):
+            return (self._next_previous_helper('previous', photoset),
+                    self._next_previous_helper('next', photoset))
+        return previous, next
+
     def get_next_in_set(self, *args, **kwargs):
         """
         Returns the next Entry with "live" status by ``pub_date``, if
@@ -167,7 +205,7 @@ class Photo(models.Model):
         does not differentiate entry status.
 
         """
-        return self._next_previous_helper('next', *args, **kwargs)
+        return self.get_neighbors_in_set(*args, **kwargs)[1]
 
     def get_previous_in_set(self, *args, **kwargs):
         """
@@ -180,7 +218,7 @@ class Photo(models.Model):
         status..
 
         """
-        return self._next_previous_helper('previous', *args, **kwargs)
+        return self.get_neighbors_in_set(*args, **kwargs)[0]
 
 class FavoriteList(models.Model):
     owner = models.CharField(max_length=50)
@@ -203,7 +241,13 @@ class PhotoSet(models.Model):
     title = models.CharField(max_length=200)
     description = models.TextField(blank=True)
     order = models.PositiveSmallIntegerField(default=0)
-    photos = models.ManyToManyField('Photo')
+    photos = models.ManyToManyField('Photo', through='PhotoSetMembership')
+    # Stored by ``update_aggregates``
+    start_date = models.DateTimeField(null=True, editable=False)
+    end_date = models.DateTimeField(null=True, editable=False)
+    photo_count = models.PositiveIntegerField(default=0, editable=False)
+    highlight_photo = models.ForeignKey('Photo', null=True, editable=False,
+                                        related_name='highlight_photo_set')
 
     class Meta:
         ordering = ('order',)
@@ -215,6 +259,41 @@ class PhotoSet(models.Model):
     def get_absolute_url(self):
         return ('photoset_detail', (), { 'object_id': self.pk })
 
+    def update_positions(self):
+        """
+        Number the photos of this set by ``taken_date``, starting at 1,
+        and store the changed positions with one bulk update.
+
+        """
+        from syncr.bulk import update_many
+        changed = []
+        members = PhotoSetMembership.objects.filter(photoset=self).order_by(
+            'photo__taken_date', 'photo').values_list('pk', 'position')
+        for position, (pk, stored) in enumerate(members):
+            if stored != position + 1:
+                changed.append(PhotoSetMembership(pk=pk, position=position + 1))
+        update_many(PhotoSetMembership, changed, ['position'])
+
+    def update_aggregates(self):
+        """
+        Compute and save the time period, photo count and highlight of
+        this set, which are used by ``get_time_period`` and ``highlight``.
+
+        """
+        aggregates = self.photos.aggregate(start=models.Min('taken_date'),
+            end=models.Max('taken_date'), count=models.Count('id'))
+        self.start_date = aggregates['start']
+        self.end_date = aggregates['end']
+        self.photo_count = aggregates['count']
+        if self.primary_id is not None:
+            self.highlight_photo_id = self.primary_id
+        else:
+            try:
+                self.highlight_photo = self.photos.all()[0]
+            except IndexError:
+                self.highlight_photo = None
+        self.save()
+
     def get_photos_ordered_by_taken_date(self):
         """
         Return related photos sorded by ``taken_date`` (asc).
@@ -228,9 +307,12 @@ class PhotoSet(models.Model):
 
         In case there isn't a ``primary`` image set, the first one is
         selected. (If this causes a ``IndexError``, ``None`` is
-        returned.)
+        returned.) Sets with stored aggregates return the stored
+        highlight.
 
         """
+        if self.highlight_photo_id is not None:
+            return self.highlight_photo
         if self.primary is not None:
             return self.primary
         try:
@@ -247,7 +329,11 @@ class PhotoSet(models.Model):
 
             { 'start': datetime.datetime, 'end': datetime.datetime }
 
+        Sets with stored aggregates return the stored dates.
+
         """
+        if self.start_date is not None:
+            return {'start': self.start_date, 'end': self.end_date}
         start_photo = self.photos.order_by('taken_date')[0]
         end_photo = self.photos.order_by('-taken_date')[0]
         if start_photo.taken_date and end_photo.taken_date:
@@ -262,6 +348,43 @@ class PhotoSet(models.Model):
     get_primary_photo.allow_tags = True
     get_primary_photo.short_description = _(u'Highlight')
 
+class PhotoSetMembership(models.Model):
+    """
+    A Photo in a PhotoSet. ``position`` is the photo's place in the set
+    by ``taken_date``, see ``PhotoSet.update_positions``.
+
+    Uses the table Django created for ``PhotoSet.photos`` before it had
+    an intermediary model; existing databases need the position column
+    added.
+    """
+    photoset = models.ForeignKey('PhotoSet')
+    photo = models.ForeignKey('Photo')
+    position = models.PositiveIntegerField(null=True, db_index=True)
+
+    class Meta:
+        db_table = 'flickr_photoset_photos'
+        unique_together = (('photoset', 'photo'),)
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.photo, self.photoset)
+
+class SyncState(models.Model):
+    """
+    Bookkeeping for incremental syncs of a flickr account.
+
+    ``last_update`` is the highest photo ``lastupdate`` synced so far.
+    ``public_offset`` is the number of photos an unfinished
+    ``syncAllPublic`` run got through, and 0 once it completes.
+    """
+    owner_nsid = models.CharField(max_length=50, unique=True)
+    owner = models.CharField(max_length=50)
+    last_update = models.DateTimeField(null=True)
+    public_offset = models.PositiveIntegerField(default=0, editable=False)
+    sync_date = models.DateTimeField()
+
+    def __unicode__(self):
+        return u"%s's sync state" % self.owner
+
 class PhotoComment(models.Model):
     flickr_id = models.CharField(primary_key=True, max_length=128)
     photo = models.ForeignKey('Photo')
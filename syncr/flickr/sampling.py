@@ -0,0 +1,65 @@
+import random
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from syncr.bulk import filter_in
+from syncr.flickr.models import Photo
+
+# Seconds the pool of random photo candidates is cached
+RANDOM_PHOTO_POOL_TIMEOUT = 24 * 60 * 60
+
+def _get_pool_key():
+    custom_filter = getattr(settings, 'FLICKR_RANDOM_PHOTO_FILTER', {}).items()
+    custom_filter.sort()
+    return 'syncr.flickr.random_photo_pool.%s' % md5(
+        repr(custom_filter)).hexdigest()
+
+def get_random_photo_pool():
+    """
+    Return the primary keys of all photos in landscape format which match
+    ``settings.FLICKR_RANDOM_PHOTO_FILTER``.
+
+    The list is kept in Django's cache until a sync changes the photos
+    (see ``invalidate_random_photo_pool``).
+    """
+    key = _get_pool_key()
+    pool = cache.get(key)
+    if pool is None:
+        custom_filter = getattr(settings, 'FLICKR_RANDOM_PHOTO_FILTER', {})
+        qn = connection.ops.quote_name
+        pool = list(Photo.objects.filter(**custom_filter).extra(
+            where=['%(width)s > %(height)s' % {
+                    'width': qn('thumbnail_width'),
+                    'height': qn('thumbnail_height')
+                    }]
+            ).order_by().values_list('pk', flat=True))
+        cache.set(key, pool, RANDOM_PHOTO_POOL_TIMEOUT)
+    return pool
+
+def invalidate_random_photo_pool():
+    """
+    Drop the cached pool, so the next ``get_random_photos`` rebuilds it.
+    """
+    cache.delete(_get_pool_key())
+
+def get_random_photos(num):
+    """
+    Return a list of ``num`` random photos from the pool, or all of them
+    in random order if ``num`` is 0. Only the drawn photos are fetched,
+    by primary key (in chunks, as the pool may be large).
+    """
+    pool = get_random_photo_pool()
+    if num == 0 or num >= len(pool):
+        sample = list(pool)
+        random.shuffle(sample)
+    else:
+        sample = random.sample(pool, num)
+    photos = dict([(photo.pk, photo) for photo in
+                   filter_in(Photo.objects.all(), 'pk', sample)])
+    return [photos[pk] for pk in sample if pk in photos]
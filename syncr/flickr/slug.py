@@ -1,7 +1,159 @@
+from syncr.bulk import MAX_PARAMS, filter_in, update_many
 from syncr.flickr.models import Photo
-from datetime import datetime
+from datetime import datetime, timedelta
+import threading
+
+from django.db.models import Count, Q
+from django.template import defaultfilters
+
+def get_day_range(taken_date):
+    """
+    Return the start and end datetimes of the day of ``taken_date``, for
+    range lookups which can use the index on ``taken_date``.
+    """
+    start = datetime(taken_date.year, taken_date.month, taken_date.day)
+    return start, start + timedelta(days=1)
+
+class SlugAllocator(object):
+    """
+    Hand out photo slugs which are unique per taken date day.
+
+    The slugs of a day are loaded with a single range query the first
+    time the day is seen and kept in memory afterwards, so a whole batch
+    of photos is served without further queries. Allocation is guarded
+    by a lock. Another sync process may hand out the same slugs at the
+    same time; ``fix_duplicates`` repairs them, but only sees the other
+    process's photos once they are committed, so it has to run after the
+    photos are committed, in a transaction of its own.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.days = {}
+        self.suffixes = {}
+
+    def _get_used_slugs(self, day):
+        if day not in self.days:
+            start, end = get_day_range(day)
+            self.days[day] = set(Photo.objects.filter(taken_date__gte=start,
+                taken_date__lt=end).values_list('slug', flat=True))
+        return self.days[day]
+
+    def allocate(self, taken_date, proposed_slug):
+        """
+        Return ``proposed_slug``, suffixed with a number if needed, so
+        that it is unique among the photos taken on the same day.
+        """
+        day = taken_date.date()
+        self.lock.acquire()
+        try:
+            used = self._get_used_slugs(day)
+            slug, l = proposed_slug, self.suffixes.get((day, proposed_slug), 1)
+            while slug in used:
+                slug = proposed_slug + '-' + str(l)
+                l = l+1
+            self.suffixes[(day, proposed_slug)] = l
+            used.add(slug)
+            return slug
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """
+        Forget the slugs loaded so far, e.g. between chunks of a long sync.
+        """
+        self.lock.acquire()
+        try:
+            self.days = {}
+            self.suffixes = {}
+        finally:
+            self.lock.release()
+
+    def fix_duplicates(self, days):
+        """
+        Give a new slug to every photo which shares its slug with an older
+        photo taken on the same day, and return a dictionary mapping the
+        primary keys of the changed photos to their new slug.
+
+        All days are checked together: one grouped query (per few hundred
+        runs of consecutive days) finds the slugs used more than once,
+        whose photos are then loaded and checked day by day. The slugs of
+        the days with duplicates are reloaded with one more query and the
+        new slugs written in bulk.
+
+        Required arguments
+          days: the dates whose photos are checked
+        """
+        duplicates = []
+        for query in _get_days_queries(days):
+            # Clear Photo's ordering, which would be added to the GROUP BY
+            photos = Photo.objects.filter(query).order_by()
+            slugs = [row['slug'] for row in photos.values('slug').annotate(
+                count=Count('id')).filter(count__gt=1)]
+            # The slugs may be shared by photos of different days
+            groups = {}
+            for pk, taken_date, slug, title in filter_in(photos.values_list(
+                    'pk', 'taken_date', 'slug', 'title'), 'slug', slugs):
+                groups.setdefault((taken_date.date(), slug), []).append(
+                    (pk, taken_date, title))
+            for group in groups.values():
+                if len(group) > 1:
+                    group.sort()
+                    duplicates.extend(group[1:])
+        if not duplicates:
+            return {}
+        duplicates.sort()
+
+        changed_days = set([taken_date.date()
+                            for pk, taken_date, title in duplicates])
+        used = dict([(day, set()) for day in changed_days])
+        for query in _get_days_queries(changed_days):
+            for taken_date, slug in Photo.objects.filter(query).values_list(
+                    'taken_date', 'slug'):
+                used[taken_date.date()].add(slug)
+        self.lock.acquire()
+        try:
+            self.days.update(used)
+        finally:
+            self.lock.release()
+
+        changed = {}
+        for pk, taken_date, title in duplicates:
+            proposed_slug = defaultfilters.slugify(title.lower())
+            changed[pk] = self.allocate(taken_date, proposed_slug)
+        update_many(Photo, [Photo(pk=pk, slug=slug)
+                            for pk, slug in changed.items()], ['slug'])
+        return changed
+
+def _get_days_queries(days):
+    """
+    Yield Q objects matching the photos taken on any of ``days``, with
+    consecutive days merged into one range and few enough ranges per
+    query to stay below the database's parameter limit.
+    """
+    ranges = []
+    for day in sorted(set(days)):
+        start, end = get_day_range(day)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    for i in range(0, len(ranges), MAX_PARAMS // 2):
+        query = None
+        for start, end in ranges[i:i + MAX_PARAMS // 2]:
+            day_query = Q(taken_date__gte=start, taken_date__lt=end)
+            if query is None:
+                query = day_query
+            else:
+                query = query | day_query
+        yield query
 
 def get_unique_slug_for_photo(taken_date, proposed_slug):
+    """
+    Return ``proposed_slug``, suffixed with a number if needed, so that it
+    is unique among the photos taken on the same day.
+
+    Use a ``SlugAllocator`` to allocate slugs for many photos.
+    """
     l=1
     calculate_slug = proposed_slug
     while check_slug_photo(taken_date, proposed_slug):
@@ -10,7 +162,8 @@ def get_unique_slug_for_photo(taken_date, proposed_slug):
     return proposed_slug
 
 def check_slug_photo(taken_date, proposed_slug):
-    if Photo.objects.filter(taken_date__year=taken_date.year, taken_date__month=taken_date.month, taken_date__day=taken_date.day).filter(slug=proposed_slug):
+    start, end = get_day_range(taken_date)
+    if Photo.objects.filter(taken_date__gte=start, taken_date__lt=end).filter(slug=proposed_slug):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
@@ -2,13 +2,11 @@
 import datetime
 
 from django import template
-from django.conf import settings
-from django.db import connection
 from django.db.models import Q
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
 
-from syncr.flickr.models import Photo
+from syncr.flickr import sampling
 
 register = template.Library()
 
@@ -25,17 +23,7 @@ class RandomPhotoNode(template.Node):
         self.num, self.varname = int(num), varname
 
     def render(self, context):
-        custom_filter = getattr(settings, 'FLICKR_RANDOM_PHOTO_FILTER', {})
-        qn = connection.ops.quote_name
-        qs = Photo.objects.filter(**custom_filter).extra(
-            where=['%(width)s > %(height)s' % {
-                    'width': qn('thumbnail_width'),
-                    'height': qn('thumbnail_height')
-                    }]
-            ).order_by('?')
-        if self.num is 0:
-            self.num = len(qs)
-        context[self.varname] = qs[:self.num]
+        context[self.varname] = sampling.get_random_photos(self.num)
         return ''
 
 @register.tag(name="get_random_photos")
@@ -47,6 +35,9 @@ def get_random_photos(parser, token):
 
     When "number" is null (0) all photos will be selected.
 
+    The candidates are drawn from a cached pool of primary keys, which is
+    rebuilt after a sync changed any photos.
+
     Syntax::
 
         {% get_random_photos [number] as [varname] %}
@@ -20,8 +20,7 @@ def flickr_photo_detail_in_set(request, year, month, day, slug, set_id,
     photo = get_object_or_404(Photo, taken_date__year=year,
         taken_date__month=month, taken_date__day=day, slug=slug)
 
-    previous = photo.get_previous_in_set(set)
-    next = photo.get_next_in_set(set)
+    previous, next = photo.get_neighbors_in_set(set)
 
     extra_context = dict(extra_context, photoset=set,
         previous_photo_in_set=previous, next_photo_in_set=next)
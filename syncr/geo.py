@@ -0,0 +1,294 @@
+"""
+A geohash index for the geotagged models of the syncr apps.
+
+A geohash encodes a point as a string of base32 characters; every
+character narrows the cell the point lies in, so all points within a
+cell share its hash as a prefix. ``GeohashField`` keeps the hash of a
+model's latitude and longitude in an indexed column, and the query
+helpers turn bounding boxes and nearest neighbour searches into a few
+indexed range lookups on it before checking exact distances.
+"""
+import math
+
+from django.db import models
+from django.db.models import Q
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Characters stored per point; 12 characters are a few centimetres
+GEOHASH_PRECISION = 12
+
+# The most cells a bounding box query looks up
+MAX_CELLS = 16
+
+EARTH_RADIUS = 6371.0 # km
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Return the geohash of a point, or ``''`` if either coordinate is
+    missing or isn't a number (picasaweb stores them as strings).
+    """
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return ''
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return ''
+    south, north, west, east = -90.0, 90.0, -180.0, 180.0
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        if even:
+            middle = (west + east) / 2
+            if longitude >= middle:
+                value, west = value * 2 + 1, middle
+            else:
+                value, east = value * 2, middle
+        else:
+            middle = (south + north) / 2
+            if latitude >= middle:
+                value, south = value * 2 + 1, middle
+            else:
+                value, north = value * 2, middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+def decode(geohash):
+    """
+    Return the (south, west, north, east) bounds of a geohash cell.
+    """
+    south, north, west, east = -90.0, 90.0, -180.0, 180.0
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in (4, 3, 2, 1, 0):
+            bit = (value >> shift) & 1
+            if even:
+                middle = (west + east) / 2
+                if bit:
+                    west = middle
+                else:
+                    east = middle
+            else:
+                middle = (south + north) / 2
+                if bit:
+                    south = middle
+                else:
+                    north = middle
+            even = not even
+    return south, west, north, east
+
+def cell_size(precision):
+    """
+    Return the height and width in degrees of the cells of a precision.
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** (bits - bits // 2)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Return the great circle distance between two points in kilometres.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+class GeohashField(models.CharField):
+    """
+    An indexed geohash of two other fields of the model, computed
+    whenever the instance is saved (including by ``syncr.bulk``).
+
+    Required arguments
+      latitude_field: the name of the latitude field
+      longitude_field: the name of the longitude field
+    """
+    def __init__(self, latitude_field, longitude_field, **kwargs):
+        self.latitude_field = latitude_field
+        self.longitude_field = longitude_field
+        kwargs.setdefault('max_length', GEOHASH_PRECISION)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('db_index', True)
+        super(GeohashField, self).__init__(**kwargs)
+
+    def get_point(self, instance):
+        """
+        Return the (latitude, longitude) of an instance as floats, or
+        ``None`` if it has no location.
+        """
+        try:
+            return (float(getattr(instance, self.latitude_field)),
+                    float(getattr(instance, self.longitude_field)))
+        except (TypeError, ValueError):
+            return None
+
+    def pre_save(self, instance, add):
+        value = encode(getattr(instance, self.latitude_field),
+                       getattr(instance, self.longitude_field),
+                       self.max_length)
+        setattr(instance, self.attname, value)
+        return value
+
+def _get_geohash_field(model):
+    for field in model._meta.fields:
+        if isinstance(field, GeohashField):
+            return field
+    raise ValueError('%s has no GeohashField' % model.__name__)
+
+def _successor(prefix):
+    """
+    Return the smallest geohash greater than all hashes starting with
+    ``prefix``, or ``None`` if there is none.
+    """
+    while prefix:
+        index = BASE32.index(prefix[-1])
+        if index + 1 < len(BASE32):
+            return prefix[:-1] + BASE32[index + 1]
+        prefix = prefix[:-1]
+    return None
+
+def _cells_query(field, cells):
+    """
+    Return a Q object matching the hashes in any of ``cells``, with
+    adjacent cells merged into a single range.
+    """
+    ranges = []
+    for cell in sorted(set(cells)):
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1][1] = _successor(cell)
+        else:
+            ranges.append([cell, _successor(cell)])
+    query = None
+    for start, end in ranges:
+        lookup = {'%s__gte' % field.name: start}
+        if end is not None:
+            lookup['%s__lt' % field.name] = end
+        if query is None:
+            query = Q(**lookup)
+        else:
+            query = query | Q(**lookup)
+    return query
+
+def _bbox_cells(south, west, north, east, precision):
+    height, width = cell_size(precision)
+    cells = []
+    lat = south
+    while True:
+        lon = west
+        while True:
+            cells.append(encode(lat, lon, precision))
+            if lon >= east:
+                break
+            lon = min(lon + width, east)
+        if lat >= north:
+            break
+        lat = min(lat + height, north)
+    return cells
+
+def within_bbox(queryset, south, west, north, east):
+    """
+    Return the objects of ``queryset`` located within a bounding box.
+
+    The box is covered by at most ``MAX_CELLS`` geohash cells, whose
+    objects are fetched with indexed range lookups and then filtered on
+    their exact coordinates. Boxes crossing the 180th meridian have a
+    ``west`` greater than ``east``.
+
+    Required arguments
+      queryset: a QuerySet of a model with a GeohashField
+      south, west, north, east: the bounds of the box in degrees
+    """
+    if west > east:
+        return within_bbox(queryset, south, west, north, 180.0) + \
+               within_bbox(queryset, south, -180.0, north, east)
+    field = _get_geohash_field(queryset.model)
+    cells = ['']
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        count = (math.floor((north - south) / height) + 2) * \
+                (math.floor((east - west) / width) + 2)
+        if count <= MAX_CELLS:
+            cells = _bbox_cells(south, west, north, east, precision)
+            break
+
+    objects = []
+    for obj in queryset.filter(_cells_query(field, cells)):
+        point = field.get_point(obj)
+        if point is not None and south <= point[0] <= north and \
+           west <= point[1] <= east:
+            objects.append(obj)
+    return objects
+
+def nearest(queryset, latitude, longitude, k=10, max_distance=None):
+    """
+    Return the ``k`` objects of ``queryset`` nearest to a point, nearest
+    first. Each object gets a ``distance`` attribute in kilometres.
+
+    The search starts with the cell of the point and its eight
+    neighbours at a fine precision and moves to coarser cells until
+    ``k`` objects are found which are closer than anything outside the
+    searched cells could be.
+
+    Required arguments
+      queryset: a QuerySet of a model with a GeohashField
+      latitude, longitude: the point in degrees
+    Optional arguments
+      k: the number of objects to return, defaults to 10
+      max_distance: leave out objects further away than this many
+                    kilometres
+    """
+    field = _get_geohash_field(queryset.model)
+    for precision in range(8, -1, -1):
+        if precision:
+            height, width = cell_size(precision)
+            cells = []
+            for dlat in (-1, 0, 1):
+                lat = max(-90.0, min(90.0, latitude + dlat * height))
+                for dlon in (-1, 0, 1):
+                    lon = (longitude + dlon * width + 180.0) % 360.0 - 180.0
+                    cells.append(encode(lat, lon, precision))
+            # Anything outside the 3x3 block is at least a cell away
+            edge = min(90.0, abs(latitude) + height)
+            reach = min(math.radians(height),
+                        math.radians(width) * math.cos(math.radians(edge)))
+            reach *= EARTH_RADIUS
+            candidates = queryset.filter(_cells_query(field, cells))
+        else:
+            reach = None
+            candidates = queryset.exclude(**{field.name: ''})
+
+        objects = []
+        for obj in candidates:
+            point = field.get_point(obj)
+            if point is None:
+                continue
+            obj.distance = haversine(latitude, longitude, point[0], point[1])
+            if max_distance is None or obj.distance <= max_distance:
+                objects.append(obj)
+        objects.sort(key=lambda obj: obj.distance)
+        objects = objects[:k]
+        if reach is None:
+            return objects
+        if len(objects) == k and objects[-1].distance <= reach or \
+           max_distance is not None and max_distance <= reach:
+            return objects
+
+def update_geohashes(queryset):
+    """
+    Recompute the geohashes of the objects in ``queryset``, e.g. of rows
+    stored before the column was added, and save the changed ones in
+    bulk. Returns the number of changed objects.
+    """
+    from syncr.bulk import update_many
+    field = _get_geohash_field(queryset.model)
+    changed = []
+    for obj in queryset.iterator():
+        stored = getattr(obj, field.attname)
+        if field.pre_save(obj, False) != stored:
+            changed.append(obj)
+    update_many(queryset.model, changed, [field.name])
+    return len(changed)
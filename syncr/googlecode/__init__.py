@@ -17,7 +17,8 @@ Each syncr app has different dependencies, but generally you should
 have ElementTree. ET is included in Python 2.5, but for older versions
 you need to download it from http://effbot.org/zone/element-index.htm.
 
-The twitter app depends on python-twitter, available at:
+The twitter app depends on python-twitter 0.8 or later (it authenticates
+with OAuth, see TwitterSyncr), available at:
 http://code.google.com/p/python-twitter/
 
 The magnolia app depends on pymagnolia, available at:
@@ -56,6 +57,15 @@ INSTALLATION / USAGE
    f.syncPublicFavorites('jesselegg')
 
 4. Explore the results in the Django admin interface.
+5. To show tweets with linked URLs, hashtags and usernames, pass the Tweet
+   itself to the twitterfy filter, so the HTML stored when it was synced
+   is used:
+
+   {% load twitterfy %}
+   {{ tweet|twitterfy }}
+
+   {{ tweet.text|twitterfy }} still works, but renders the text on every
+   request.
 
 CHANGELOG
 
@@ -1,6 +1,8 @@
 from django.db import models
 from tagging.fields import TagField
 
+from syncr.geo import GeohashField
+
 PICASAWEB_ACCESS = (
     ('private', 'Private'),
     ('public', 'Public'),
@@ -27,6 +29,7 @@ class Photo(models.Model):
     #license = models.CharField(max_length=50, choices=FLICKR_LICENSES)
     geo_latitude = models.CharField(max_length=50, blank=True)
     geo_longitude = models.CharField(max_length=50, blank=True)
+    geohash = GeohashField('geo_latitude', 'geo_longitude')
     #geo_accuracy = models.CharField(max_length=50, blank=True)
     exif_make  = models.CharField(max_length=50, blank=True)
     exif_model = models.CharField(max_length=50, blank=True)
@@ -0,0 +1,73 @@
+"""
+A compact representation of the Twitter friend and follower graphs.
+
+Besides the ``friends`` and ``followers`` many-to-many tables, graph
+syncs store every user's friend and follower ids as one sorted, packed
+column (``PackedIdsField``). Set operations between two such lists are
+merges over sorted lists, which avoids self-joins of the edge tables.
+"""
+import base64
+import struct
+
+from django.db import models
+
+class PackedIdsField(models.TextField):
+    """
+    A sorted list of distinct non-negative integer ids, stored as the
+    base64 encoding of 8-byte big-endian integers. ``None`` means the
+    list was never synced.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('editable', False)
+        super(PackedIdsField, self).__init__(**kwargs)
+
+    def to_python(self, value):
+        if value is None:
+            return None
+        if isinstance(value, basestring):
+            data = base64.b64decode(value)
+            return list(struct.unpack('>%dQ' % (len(data) // 8), data))
+        return sorted(set(value))
+
+    def get_db_prep_value(self, value):
+        if value is None:
+            return None
+        ids = sorted(set(value))
+        return base64.b64encode(struct.pack('>%dQ' % len(ids), *ids))
+
+def intersection(a, b):
+    """
+    Return the ids in both of the sorted lists ``a`` and ``b``.
+    """
+    result, i, j = [], 0, 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            result.append(a[i])
+            i += 1
+            j += 1
+    return result
+
+def difference(a, b):
+    """
+    Return the ids of the sorted list ``a`` which aren't in the sorted
+    list ``b``.
+    """
+    result, i, j = [], 0, 0
+    while i < len(a):
+        if j == len(b) or a[i] < b[j]:
+            result.append(a[i])
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+    return result
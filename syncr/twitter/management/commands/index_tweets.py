@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', '-b', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of tweets indexed per query'),
+    )
+
+    help = "Store the mentions, hashtags and links of all synced tweets."
+    args = ""
+
+    requires_model_validation = True
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("index_tweets takes no arguments")
+
+        from django.db import transaction
+        from syncr.twitter.models import Tweet, index_entities
+
+        # Replace each batch's entities atomically
+        index_batch = transaction.commit_on_success(index_entities)
+
+        batch_size = options.get('batch_size') or 500
+        tweets = Tweet.objects.order_by('pk')
+
+        last_pk, count = 0, 0
+        while True:
+            batch = list(tweets.filter(pk__gt=last_pk).values_list(
+                'pk', 'text')[:batch_size])
+            if not batch:
+                break
+            index_batch(batch, replace=True)
+            last_pk = batch[-1][0]
+            count += len(batch)
+            print "Indexed %d tweets" % count
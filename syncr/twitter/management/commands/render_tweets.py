@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', '-b', action='store', type='int',
+                    dest='batch_size', default=500,
+                    help='Number of tweets rendered per query'),
+        make_option('--all', '-a', action='store_true', dest='all',
+                    default=False,
+                    help='Re-render all tweets, not only those without HTML'),
+    )
+
+    help = "Store the rendered HTML of tweets synced before it was kept."
+    args = ""
+
+    requires_model_validation = True
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("render_tweets takes no arguments")
+
+        from syncr.bulk import update_many
+        from syncr.twitter.models import Tweet
+        from syncr.twitter.text import render_html
+
+        batch_size = options.get('batch_size') or 500
+        tweets = Tweet.objects.order_by('pk')
+        if not options.get('all'):
+            tweets = tweets.filter(html='')
+
+        last_pk, count = 0, 0
+        while True:
+            batch = list(tweets.filter(pk__gt=last_pk).values_list(
+                'pk', 'text')[:batch_size])
+            if not batch:
+                break
+            update_many(Tweet, [Tweet(pk=pk, html=render_html(text))
+                                for pk, text in batch], ['html'])
+            last_pk = batch[-1][0]
+            count += len(batch)
+            print "Rendered %d tweets" % count
@@ -1,13 +1,38 @@
 from django.db import models
 from django.conf import settings
 from syncr.flickr.models import BigIntegerField
+from syncr.twitter.graph import PackedIdsField, difference, intersection
+
+class TweetManager(models.Manager):
+    def mentioning(self, screen_name):
+        """
+        Return the tweets mentioning a screen name (with or without @).
+        """
+        return self.filter(
+            mentions__screen_name=screen_name.lstrip('@').lower())
+
+    def tagged(self, hashtag):
+        """
+        Return the tweets tagged with a hashtag (with or without #).
+        """
+        return self.filter(hashtags__tag=hashtag.lstrip('#').lower())
+
+    def linking(self, url):
+        """
+        Return the tweets linking to a URL.
+        """
+        return self.filter(urls__url=url)
 
 class Tweet(models.Model):
     pub_time    = models.DateTimeField(db_index=True)
     twitter_id  = BigIntegerField(unique=True)
     text        = models.TextField()
+    # text rendered by syncr.twitter.text.render_html when synced
+    html        = models.TextField(blank=True, editable=False)
     user        = models.ForeignKey('TwitterUser')
 
+    objects = TweetManager()
+
     def __unicode__(self):
         return u'%s %s' % (self.user.screen_name, self.pub_time)
 
@@ -24,18 +49,26 @@ class Tweet(models.Model):
 	return self.pub_time.replace(tzinfo=pytz.utc).astimezone(zone)
     
 class TwitterUser(models.Model):
+    twitter_id  = BigIntegerField(null=True, db_index=True)
     screen_name = models.CharField(max_length=50)
     description = models.CharField(max_length=250, blank=True, null=True)
     location    = models.CharField(max_length=50, blank=True, null=True)
     name        = models.CharField(max_length=50, blank=True, null=True)
     thumbnail_url = models.URLField()
     url         = models.URLField(blank=True, null=True)
+    # The newest status ids seen by incremental syncs
+    last_tweet_id = BigIntegerField(null=True, editable=False)
+    last_friends_tweet_id = BigIntegerField(null=True, editable=False)
     friends     = models.ManyToManyField('self', symmetrical=False,
 					 blank=True, null=True,
 					 related_name='friends_user_set')
     followers   = models.ManyToManyField('self', symmetrical=False,
 					 blank=True, null=True,
 					 related_name='followers_user_set')
+    # Sorted Twitter ids of the friends and followers, replaced by graph
+    # syncs and extended whenever TwitterSyncr adds friends or followers
+    friend_ids  = PackedIdsField()
+    follower_ids = PackedIdsField()
 
     def numFriends(self):
         return self.friends.count()
@@ -43,5 +76,78 @@ class TwitterUser(models.Model):
     def numFollowers(self):
         return self.followers.count()
 
+    def commonFriendIds(self, other):
+        """
+        Return the Twitter ids of the friends this user shares with
+        another TwitterUser, from the packed id lists.
+        """
+        return intersection(self.friend_ids or [], other.friend_ids or [])
+
+    def mutualIds(self):
+        """
+        Return the Twitter ids of the friends who follow this user back.
+        """
+        return intersection(self.friend_ids or [], self.follower_ids or [])
+
+    def fanIds(self):
+        """
+        Return the Twitter ids of the followers this user doesn't follow.
+        """
+        return difference(self.follower_ids or [], self.friend_ids or [])
+
     def __unicode__(self):
         return self.screen_name
+
+# The mentions, hashtags and links of tweets, extracted by
+# syncr.twitter.text.extract_entities so they can be looked up by index
+class TweetMention(models.Model):
+    tweet       = models.ForeignKey(Tweet, related_name='mentions')
+    screen_name = models.CharField(max_length=50, db_index=True)
+
+    def __unicode__(self):
+        return u'@%s' % self.screen_name
+
+class TweetHashtag(models.Model):
+    tweet       = models.ForeignKey(Tweet, related_name='hashtags')
+    tag         = models.CharField(max_length=140, db_index=True)
+
+    def __unicode__(self):
+        return u'#%s' % self.tag
+
+class TweetURL(models.Model):
+    tweet       = models.ForeignKey(Tweet, related_name='urls')
+    url         = models.URLField(max_length=255, db_index=True)
+
+    def __unicode__(self):
+        return self.url
+
+def index_entities(tweets, replace=False):
+    """
+    Store the entities of tweets in the side tables, with one multi-row
+    INSERT per table.
+
+    Required arguments
+      tweets: a list of (tweet primary key, text) pairs
+    Optional arguments
+      replace: delete the stored entities of the tweets first, e.g. when
+               re-indexing them
+    """
+    from syncr.bulk import insert_many
+    from syncr.twitter.text import extract_entities
+    if replace:
+        pks = [pk for pk, text in tweets]
+        for model in (TweetMention, TweetHashtag, TweetURL):
+            for i in range(0, len(pks), 500):
+                model.objects.filter(tweet__in=pks[i:i + 500]).delete()
+    mentions, hashtags, urls = [], [], []
+    for pk, text in tweets:
+        found = extract_entities(text)
+        mentions.extend([TweetMention(tweet_id=pk, screen_name=name[:50])
+                         for name in found[0]])
+        hashtags.extend([TweetHashtag(tweet_id=pk, tag=tag[:140])
+                         for tag in found[1]])
+        urls.extend([TweetURL(tweet_id=pk, url=url[:255])
+                     for url in found[2]])
+    insert_many(TweetMention, mentions)
+    insert_many(TweetHashtag, hashtags)
+    insert_many(TweetURL, urls)
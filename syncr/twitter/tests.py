@@ -0,0 +1,109 @@
+import time
+
+from django.test import TestCase
+from django.utils import simplejson
+
+from syncr.app.tweet import TwitterSyncr
+from syncr.twitter.models import Tweet, TwitterUser
+
+def user_dict(twitter_id, screen_name):
+    return {'id': twitter_id, 'screen_name': screen_name, 'name': screen_name,
+            'description': '', 'location': '', 'url': None,
+            'profile_image_url': 'http://example.com/%s.png' % screen_name}
+
+def status_dict(status_id, user):
+    return {'id': status_id, 'text': u'status %d' % status_id, 'user': user,
+            'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y',
+                                        time.gmtime(1240000000 + status_id))}
+
+class StubFetcher(object):
+    """
+    Stands in for twitter.Api._FetchUrl, so the real python-twitter
+    request building (and argument checking) runs without any HTTP.
+    """
+    def __init__(self):
+        self.users = {'bob': user_dict(1, 'bob'), 'al': user_dict(2, 'al')}
+        self.statuses = [status_dict(i, self.users[('bob', 'al')[i % 2]])
+                         for i in range(100, 350)]
+        self.friend_ids = range(1000, 1150)
+        self.requests = []
+
+    def __call__(self, url, post_data=None, parameters=None, **kwargs):
+        parameters = parameters or {}
+        self.requests.append((url, parameters))
+        if '/users/show/' in url:
+            data = self.users[url.split('/')[-1][:-len('.json')]]
+        elif '/statuses/friends_timeline/' in url:
+            since_id = int(parameters.get('since_id') or 0)
+            count = int(parameters.get('count', 20))
+            page = int(parameters.get('page', 1))
+            statuses = [s for s in reversed(self.statuses)
+                        if s['id'] > since_id]
+            data = statuses[(page - 1) * count:page * count]
+        elif '/friends/ids/' in url:
+            # Two cursored pages
+            cursor = int(parameters.get('cursor', -1))
+            if cursor == -1:
+                data = {'ids': self.friend_ids[:100], 'next_cursor': 1}
+            else:
+                data = {'ids': self.friend_ids[100:], 'next_cursor': 0}
+        elif url.endswith('/users/lookup.json'):
+            ids = [int(i) for i in parameters['user_id'].split(',')]
+            assert len(ids) <= 100
+            data = [user_dict(i, 'user%d' % i) for i in ids]
+        else:
+            raise AssertionError('unexpected request %s' % url)
+        return simplejson.dumps(data)
+
+class FriendsTweetsTest(TestCase):
+    def setUp(self):
+        self.syncr = TwitterSyncr('bob', 'key', 'secret', 'token', 'secret')
+        self.fetch = self.syncr.api._FetchUrl = StubFetcher()
+
+    def timelineRequests(self):
+        return [parameters for url, parameters in self.fetch.requests
+                if 'friends_timeline' in url]
+
+    def testIncrementalFriendsTweets(self):
+        self.syncr.syncFriendsTweets('bob', incremental=True)
+        self.assertEqual(Tweet.objects.count(), 100)
+        self.assertEqual(TwitterUser.objects.get(
+            screen_name='bob').last_friends_tweet_id, 349)
+
+        self.fetch.statuses.append(status_dict(350, self.fetch.users['al']))
+        self.fetch.requests = []
+        self.syncr.syncFriendsTweets('bob', incremental=True)
+        self.assertEqual(Tweet.objects.count(), 101)
+        requests = self.timelineRequests()
+        self.assertEqual(requests[0]['since_id'], 349)
+        for parameters in requests:
+            self.failIf(int(parameters['count']) > 100)
+
+class GraphTest(TestCase):
+    def setUp(self):
+        self.syncr = TwitterSyncr('bob', 'key', 'secret', 'token', 'secret')
+        self.fetch = self.syncr.api._FetchUrl = StubFetcher()
+
+    def testFriendsGraph(self):
+        self.syncr.syncFriendsGraph('bob')
+        bob = TwitterUser.objects.get(screen_name='bob')
+        self.assertEqual(bob.friends.count(), 150)
+        self.assertEqual(bob.friend_ids, range(1000, 1150))
+
+        self.fetch.friend_ids = range(1050, 1160)
+        self.fetch.requests = []
+        self.syncr.syncFriendsGraph('bob')
+        bob = TwitterUser.objects.get(screen_name='bob')
+        self.assertEqual(bob.friends.count(), 110)
+        self.assertEqual(bob.friend_ids, range(1050, 1160))
+        lookups = [parameters for url, parameters in self.fetch.requests
+                   if url.endswith('/users/lookup.json')]
+        self.assertEqual(len(lookups), 1)
+
+    def testFriendsTweetsKeepPackedIds(self):
+        self.syncr.syncFriendsGraph('bob')
+        self.syncr.syncFriendsTweets('bob', incremental=True)
+        bob = TwitterUser.objects.get(screen_name='bob')
+        self.assertEqual(bob.friend_ids, sorted(bob.friends.values_list(
+            'twitter_id', flat=True)))
+        self.failUnless(2 in bob.friend_ids)
@@ -0,0 +1,55 @@
+"""
+Parsing of tweet texts: links, #hashtags and @mentions.
+
+``render_html`` turns a tweet into HTML with one pass of a combined
+pattern, so tweets can be rendered once when they are synced and the
+result stored in ``Tweet.html``.
+"""
+import re
+
+hashtag_pattern = re.compile(r"#(?P<hashtag>[A-Za-z_]+)")
+user_pattern = re.compile(r"@(?P<user>[A-Za-z0-9_]+)")
+link_pattern = re.compile(r'(?P<url>https?://[\w\-\.\&\?\/]+)')
+
+# Links first, so nothing inside a link is taken for a hashtag or user
+token_pattern = re.compile('|'.join([link_pattern.pattern,
+                                     hashtag_pattern.pattern,
+                                     user_pattern.pattern]))
+
+LINK_HTML = u'<a href="%(url)s" title="%(url)s">%(url)s</a>'
+HASHTAG_HTML = u'#<a href="http://search.twitter.com/search?q=%(hashtag)s"  title="#%(hashtag)s search Twitter">%(hashtag)s</a>'
+USER_HTML = u'<a href="http://twitter.com/%(user)s"  title="#%(user)s on Twitter">@%(user)s</a>'
+
+def _render_token(match):
+    if match.group('url'):
+        return LINK_HTML % match.groupdict()
+    if match.group('hashtag'):
+        return HASHTAG_HTML % match.groupdict()
+    return USER_HTML % match.groupdict()
+
+def render_html(text):
+    """
+    Return the HTML of a tweet's text, with links made clickable and
+    hashtags and users linked to Twitter. Like the text Twitter returns,
+    the result is not escaped any further.
+    """
+    return token_pattern.sub(_render_token, text)
+
+def extract_entities(text):
+    """
+    Return the distinct (mentions, hashtags, urls) of a tweet's text,
+    found by the same pattern as ``render_html``. Screen names and
+    hashtags are lowercased, since Twitter matches them regardless of
+    case.
+    """
+    mentions, hashtags, urls = [], [], []
+    for match in token_pattern.finditer(text):
+        if match.group('url'):
+            found, value = urls, match.group('url')
+        elif match.group('hashtag'):
+            found, value = hashtags, match.group('hashtag').lower()
+        else:
+            found, value = mentions, match.group('user').lower()
+        if value not in found:
+            found.append(value)
+    return mentions, hashtags, urls